@@ -1,6 +1,19 @@
+import os
+import re
 import sys
+import mmap
+import errno
+import pickle
+import marshal
+import hashlib
+import bisect
 import inspect
+import tempfile
+import tokenize
+import functools
 import itertools
+import collections
+import multiprocessing
 
 from pygments import highlight
 from pygments.token import Comment, Text, String, Keyword, Name, Operator
@@ -24,12 +37,331 @@ def indent(line, indentation):
     return "\n".join(map(lambda x: indentation + x, line.split("\n")))
 
 
-def to_node(node, parent=None, on_attribute=None):
-    class_name = "".join(map(lambda x: x.capitalize(), node["type"].split("_"))) + "Node"
-    if class_name in globals():
-        return globals()[class_name](node, parent=parent, on_attribute=on_attribute)
+def node_class_name(node_type):
+    "Return the name of the class used to represent the given baron type"
+    return "".join(map(lambda x: x.capitalize(), node_type.split("_"))) + "Node"
+
+
+def node_identifiers(klass, node_type):
+    "Return the frozenset of the identifiers that match the nodes of this class in a query"
+    return frozenset(x.lower() for x in [
+        node_type,
+        klass.__name__,
+        klass.__name__.replace("Node", ""),
+        node_type + "_"
+    ] + klass._other_identifiers)
+
+
+def get_node_types(identifier):
+    "Return the frozenset of the types of the nodes matching identifier in a query"
+    return node_types_by_identifier.get(identifier.lower(), frozenset())
+
+
+def to_node(node, parent=None, on_attribute=None, lazy=False):
+    return node_classes[node["type"]](node, parent=parent, on_attribute=on_attribute, lazy=lazy)
+
+
+def copy_fst(fst):
+    "Return a copy of a FST (or of a part of it)"
+    if isinstance(fst, dict):
+        return dict((key, copy_fst(value)) for key, value in fst.items())
+    if isinstance(fst, list):
+        return [copy_fst(x) for x in fst]
+    if isinstance(fst, (BinaryDict, BinaryList)):
+        return fst.decode()
+    return fst
+
+
+def normalize_raw_fst(fst):
+    """
+    Return a copy of a raw FST kept by a lazy node (a node or a list of
+    nodes) in the form that fst() gives once it is built: only the keys
+    of nodes_rendering_order are kept and empty nodes are {}
+    """
+    if isinstance(fst, (list, BinaryList)):
+        return [normalize_raw_fst(x) for x in fst]
+
+    node_type = fst["type"]
+    if "fst" in vars(node_classes[node_type]):
+        # this class has its own form, like IntNode
+        return to_node(fst).fst()
+
+    to_return = {"type": node_type}
+    for key, kind in node_schemas[node_type].steps:
+        value = fst[key]
+        if kind == NodeSchema.LIST:
+            to_return[key] = [normalize_raw_fst(x) for x in value]
+        elif kind == NodeSchema.STR or isinstance(value, string_instance):
+            to_return[key] = value
+        else:
+            to_return[key] = normalize_raw_fst(value) if value else {}
+    return to_return
+
+
+def _dependency_met(get, dependent):
+    """
+    Is an entry of nodes_rendering_order rendered, given its "dependent"
+    field and a function returning the FST value of a key (see
+    baron.render.render_node)
+    """
+    if dependent is True:
+        return True
+    if isinstance(dependent, string_instance):
+        return bool(get(dependent))
+    return all(get(x) for x in dependent)
+
+
+def _dump_raw_fst(fst, parts):
+    "Append the source code of a raw FST to parts, the same way as baron.dumps"
+    if isinstance(fst, string_instance):
+        parts.append(fst)
+    elif isinstance(fst, (dict, BinaryDict)):
+        for kind, key, dependent in node_schemas[fst["type"]].render_steps:
+            if not _dependency_met(fst.get, dependent):
+                continue
+            if kind == "constant":
+                parts.append(key)
+            else:
+                _dump_raw_fst(fst[key], parts)
     else:
-        return type(class_name, (Node,), {})(node, parent=parent, on_attribute=on_attribute)
+        for x in fst:
+            _dump_raw_fst(x, parts)
+
+
+# Binary format of a FST
+#
+# file := MAGIC strings value
+# strings := varint count, count * (varint length, utf-8 bytes)
+# value := tag byte, then depending on the tag:
+#   NONE, TRUE, FALSE: nothing
+#   STRING: varint index in strings (every string is only stored once)
+#   INT: zigzag varint
+#   DICT: varint count, count * (varint key index, varint value size, value)
+#   LIST: varint count, count * varint item size, items
+#
+# The sizes allow to access a key or an item without decoding the ones
+# before it, this way a file can be memory mapped and only the parts of
+# the FST that are used get decoded (see BinaryDict and BinaryList).
+
+BINARY_MAGIC = b"RBFST\x01"
+TAG_NONE, TAG_TRUE, TAG_FALSE, TAG_STRING, TAG_INT, TAG_DICT, TAG_LIST = range(7)
+
+if python_version == 3:
+    _byte_at = lambda buffer, position: buffer[position]
+else:
+    _byte_at = lambda buffer, position: ord(buffer[position])
+
+
+def _encode_varint(number, output):
+    while number > 0x7f:
+        output.append((number & 0x7f) | 0x80)
+        number >>= 7
+    output.append(number)
+
+
+def _decode_varint(buffer, position):
+    "Return the number and the position after it"
+    number = shift = 0
+    while True:
+        byte = _byte_at(buffer, position)
+        position += 1
+        number |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return number, position
+        shift += 7
+
+
+def fst_to_binary(fst):
+    "Encode a FST into the RedBaron binary format"
+    strings = {}
+
+    def string_index(string):
+        if string not in strings:
+            strings[string] = len(strings)
+        return strings[string]
+
+    def encode(value):
+        output = bytearray()
+        if value is None:
+            output.append(TAG_NONE)
+        elif value is True:
+            output.append(TAG_TRUE)
+        elif value is False:
+            output.append(TAG_FALSE)
+        elif isinstance(value, string_instance):
+            output.append(TAG_STRING)
+            _encode_varint(string_index(value), output)
+        elif isinstance(value, int):
+            output.append(TAG_INT)
+            _encode_varint(value * 2 if value >= 0 else -value * 2 - 1, output)
+        elif isinstance(value, dict):
+            output.append(TAG_DICT)
+            _encode_varint(len(value), output)
+            for key, sub_value in value.items():
+                encoded = encode(sub_value)
+                _encode_varint(string_index(key), output)
+                _encode_varint(len(encoded), output)
+                output += encoded
+        elif isinstance(value, list):
+            output.append(TAG_LIST)
+            _encode_varint(len(value), output)
+            items = [encode(x) for x in value]
+            for item in items:
+                _encode_varint(len(item), output)
+            for item in items:
+                output += item
+        else:
+            raise ValueError("Can't encode %r in a FST" % (value,))
+        return output
+
+    body = encode(fst)
+    output = bytearray(BINARY_MAGIC)
+    _encode_varint(len(strings), output)
+    for string, _ in sorted(strings.items(), key=lambda x: x[1]):
+        string = string.encode("Utf-8")
+        _encode_varint(len(string), output)
+        output += string
+    output += body
+    return bytes(output)
+
+
+def binary_to_fst(buffer):
+    """
+    Return the FST encoded in this buffer (bytes, mmap...) in the RedBaron
+    binary format. Dicts and lists are only decoded on access, see
+    BinaryDict and BinaryList.
+    """
+    if buffer[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("Not a RedBaron binary FST")
+
+    position = len(BINARY_MAGIC)
+    count, position = _decode_varint(buffer, position)
+    strings = []
+    for _ in range(count):
+        length, position = _decode_varint(buffer, position)
+        strings.append(buffer[position:position + length].decode("Utf-8"))
+        position += length
+
+    return _decode_binary_value(buffer, strings, position)
+
+
+def _decode_binary_value(buffer, strings, position):
+    tag = _byte_at(buffer, position)
+    position += 1
+    if tag == TAG_NONE:
+        return None
+    if tag == TAG_TRUE:
+        return True
+    if tag == TAG_FALSE:
+        return False
+    if tag == TAG_STRING:
+        return strings[_decode_varint(buffer, position)[0]]
+    if tag == TAG_INT:
+        number = _decode_varint(buffer, position)[0]
+        return number // 2 if not number % 2 else -(number + 1) // 2
+    if tag == TAG_DICT:
+        if _byte_at(buffer, position) == 0:
+            return {}
+        return BinaryDict(buffer, strings, position)
+    if tag == TAG_LIST:
+        return BinaryList(buffer, strings, position)
+    raise ValueError("Unknown tag %s in binary FST" % tag)
+
+
+class BinaryDict(object):
+    "Read only dict of a binary FST, the values are decoded on access"
+    __slots__ = ("_buffer", "_strings", "_position", "_offsets")
+
+    def __init__(self, buffer, strings, position):
+        self._buffer = buffer
+        self._strings = strings
+        self._position = position
+        self._offsets = None
+
+    def _get_offsets(self):
+        if self._offsets is None:
+            self._offsets = {}
+            count, position = _decode_varint(self._buffer, self._position)
+            for _ in range(count):
+                key, position = _decode_varint(self._buffer, position)
+                size, position = _decode_varint(self._buffer, position)
+                self._offsets[self._strings[key]] = position
+                position += size
+        return self._offsets
+
+    def __getitem__(self, key):
+        return _decode_binary_value(self._buffer, self._strings, self._get_offsets()[key])
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __contains__(self, key):
+        return key in self._get_offsets()
+
+    def __iter__(self):
+        return iter(self._get_offsets())
+
+    def keys(self):
+        return list(self)
+
+    def __len__(self):
+        return len(self._get_offsets())
+
+    def decode(self):
+        return dict((key, copy_fst(self[key])) for key in self)
+
+    # the buffer can be a mmap, which can't be pickled
+    def __reduce__(self):
+        return (dict, (self.decode(),))
+
+
+class BinaryList(object):
+    "Read only list of a binary FST, the items are decoded on access"
+    __slots__ = ("_buffer", "_strings", "_position", "_offsets")
+
+    def __init__(self, buffer, strings, position):
+        self._buffer = buffer
+        self._strings = strings
+        self._position = position
+        self._offsets = None
+
+    def _get_offsets(self):
+        if self._offsets is None:
+            count, position = _decode_varint(self._buffer, self._position)
+            sizes = []
+            for _ in range(count):
+                size, position = _decode_varint(self._buffer, position)
+                sizes.append(size)
+            self._offsets = []
+            for size in sizes:
+                self._offsets.append(position)
+                position += size
+        return self._offsets
+
+    def __getitem__(self, index):
+        return _decode_binary_value(self._buffer, self._strings, self._get_offsets()[index])
+
+    def __iter__(self):
+        for offset in self._get_offsets():
+            yield _decode_binary_value(self._buffer, self._strings, offset)
+
+    def __len__(self):
+        return len(self._get_offsets())
+
+    def decode(self):
+        return [copy_fst(x) for x in self]
+
+    def __reduce__(self):
+        return (list, (self.decode(),))
+
+
+# like baron.path.make_path, without creating a new namedtuple class (and
+# deep copying its arguments) for each path
+BaronPath = collections.namedtuple("Path", ["path", "node_type", "position_in_rendering_list"])
+
+
+def make_baron_path(path=None, node_type=None, position_in_rendering_list=None):
+    return BaronPath([] if path is None else list(path), node_type, position_in_rendering_list)
 
 
 class Path(object):
@@ -54,10 +386,44 @@ class Path(object):
     def set_node(self, node):
         self.node = node
 
+        # the path of a node of a RedBaron instance is cached on the node
+        # until the next modification of the tree (see RedBaron._version),
+        # as long as it still leads to the node (.data can be modified
+        # directly)
+        root = node._get_root() if isinstance(node, Node) else None
+        if isinstance(root, RedBaron):
+            cache = node._path_cache
+            if cache is not None and cache[0] is root and cache[1] == root._version and Path._leads_to(root, cache[2], node):
+                self.path = cache[2]
+                return
+
+        self.path = Path._compute_path(node)
+
+        if isinstance(root, RedBaron):
+            object.__setattr__(node, "_path_cache", (root, root._version, self.path))
+
+    @staticmethod
+    def _leads_to(root, path, node):
+        "Does this baron path, from root, lead to node?"
+        holder = root
+        try:
+            for key in path.path:
+                holder = getattr(holder, key) if isinstance(key, string_instance) else holder.data[key]
+
+            if isinstance(holder, NodeList):
+                target = holder.data[path.position_in_rendering_list]
+            else:
+                target = getattr(holder, nodes_rendering_order[holder.type][path.position_in_rendering_list][1])
+        except (IndexError, AttributeError, TypeError):
+            return False
+
+        return target is node
+
+    @staticmethod
+    def _compute_path(node):
         parent = Path.get_holder(node)
         if parent is None:
-            self.path = baron.path.make_path()
-            return
+            return make_baron_path()
 
         parent_node_type = parent.type if isinstance(parent, Node) else 'list'
         render_pos, _ = Path.get_position_to_parent(node)
@@ -66,10 +432,71 @@ class Path(object):
         while parent is not None:
             _, key = Path.get_position_to_parent(parent)
             if key is not None:
-                path.insert(0, key)
+                path.append(key)
             parent = Path.get_holder(parent)
 
-        self.path = baron.path.make_path(path, parent_node_type, render_pos)
+        path.reverse()
+        return make_baron_path(path, parent_node_type, render_pos)
+
+    @staticmethod
+    def _get_keys(node):
+        "Return the keys going from the root of the tree to node (a node or a node list)"
+        keys = list(Path._compute_path(node).path)
+        _, key = Path.get_position_to_parent(node)
+        if key is not None:
+            keys.append(key)
+        return keys
+
+    @classmethod
+    def from_subtree(class_, root):
+        """
+        Return the paths of root (a node or a node list) and of all the
+        nodes under it that a query can return (see find_all), in document
+        order
+
+        The paths are computed in a single walk of the subtree, from the
+        path of root, instead of going up to the root of the tree for each
+        node.
+        """
+        # (node, its path, the keys going from the root to the node)
+        if isinstance(root, NodeList):
+            keys = Path._get_keys(root)
+            stack = [(x, make_baron_path(keys, "list", position), keys + [position]) for position, x in enumerate(root.data)]
+            stack.reverse()
+        else:
+            stack = [(root, class_(root).path, Path._get_keys(root))]
+
+        version_root = stack[0][0]._get_root() if stack else None
+        if not isinstance(version_root, RedBaron):
+            version_root = None
+
+        paths = []
+        while stack:
+            node, path, keys = stack.pop()
+            to_return = class_.__new__(class_)
+            to_return.node = node
+            to_return.path = path
+            paths.append(to_return)
+
+            if version_root is not None:
+                object.__setattr__(node, "_path_cache", (version_root, version_root._version, path))
+
+            children = []
+            positions = node_schemas[node.type].render_positions
+            for key in node._child_keys:
+                value = getattr(node, key)
+                if isinstance(value, NodeList):
+                    list_keys = keys + [key]
+                    for position, child in enumerate(value.data):
+                        if isinstance(child, Node):
+                            children.append((child, make_baron_path(list_keys, "list", position), list_keys + [position]))
+                elif isinstance(value, Node):
+                    children.append((value, make_baron_path(keys, node.type, positions[key]), keys + [key]))
+
+            children.reverse()
+            stack.extend(children)
+
+        return paths
 
     def __eq__(self, other):
         return not self != other
@@ -98,6 +525,66 @@ class Path(object):
         to_return.path = path
         return to_return
 
+    @classmethod
+    def from_baron_paths(class_, node, paths):
+        """
+        Like from_baron_path for many paths at once, the paths are returned
+        in the same order than the given baron paths
+
+        The paths are sorted into a prefix tree so the steps shared by
+        several paths are only followed once.
+        """
+        paths = list(paths)
+        to_return = [None] * len(paths)
+
+        # key -> subtree, the indexes of the paths ending at a subtree are
+        # stored under the None key
+        tree = {}
+        for index, path in enumerate(paths):
+            if baron.path.is_empty(path):
+                to_return[index] = class_(node)
+                continue
+
+            current = tree
+            for key in path.path:
+                child = current.get(key)
+                if child is None:
+                    child = current[key] = {}
+                current = child
+
+            ends = current.get(None)
+            if ends is None:
+                current[None] = [index]
+            else:
+                ends.append(index)
+
+        stack = [(node, tree)]
+        while stack:
+            holder, children = stack.pop()
+
+            ends = children.pop(None, None)
+            if ends is not None:
+                rendered = None if isinstance(holder, NodeList) else holder._render()
+                for index in ends:
+                    position = paths[index].position_in_rendering_list
+                    if rendered is None:
+                        target = holder[position]
+                    else:
+                        target = getattr(holder, rendered[position][1])
+
+                    path = class_.__new__(class_)
+                    path.node = target
+                    path.path = paths[index]
+                    to_return[index] = path
+
+            for key, child in children.items():
+                if isinstance(key, string_instance):
+                    stack.append((getattr(holder, key), child))
+                else:
+                    stack.append((holder[key], child))
+
+        return to_return
+
     def to_baron_path(self):
         return self.path
 
@@ -115,45 +602,759 @@ class Path(object):
             return (None, None)
 
         if isinstance(parent, NodeList):
-            pos = parent.index(node)
+            pos = parent._index_of(node)
             return (pos, pos)
 
+        positions = node_schemas[parent.type].render_positions
         if isinstance(node, NodeList):
-            return next((pos, key) for pos, (_, key, _) in enumerate(parent._render()) if getattr(parent, key) is node)
+            key = next(key for key in parent._list_keys if not parent._is_lazy(key) and getattr(parent, key) is node)
+            return (positions[key], key)
+
+        return (positions[node.on_attribute], node.on_attribute)
+
+
+class NodeIndex(object):
+    """Index of the nodes of a tree by type, see RedBaron.enable_index
+
+    Every node gets a position, growing in the document order (the order
+    in which find_all returns the nodes), and the position of the last
+    node of its subtree, so the nodes of a type under a node are a slice
+    of the list of the nodes of this type.
+
+    The values of the string attributes (see Node._str_keys) of the nodes
+    of a type are also indexed, on the first query filtering on them, so
+    find_all("name", value="x") doesn't look at the other names.
+
+    The index is kept in sync with the tree without being rebuilt: the
+    nodes whose children have changed are noted (see changed) and, on the
+    next query, only the children that have been replaced are removed
+    from the index and the new ones are added (see _splice). Positions
+    are spaced out so the new nodes fit between the positions of their
+    neighbours, the index is only rebuilt when there is no room left.
+    Setting a string attribute only moves the node in the values index
+    (see set_value).
+    """
+    # space between two consecutive positions when the index is built
+    GAP = 1 << 32
+    # over this number of pending changes, the index is rebuilt instead
+    MAX_PENDING = 1000
+
+    def __init__(self, root):
+        self.root = root
+        # built on the first query, see update
+        self.nodes = None
+        self.pending = []
+
+    def changed(self, modified):
+        "Note that the children of modified (a node or a node list) have changed"
+        if self.nodes is None:
+            return
+
+        if isinstance(modified, NodeList) and modified.parent is not None:
+            modified = modified.parent
+
+        if len(self.pending) >= self.MAX_PENDING:
+            self.nodes = None
+            self.pending = []
+        else:
+            self.pending.append(modified)
+
+    def update(self):
+        if self.nodes is not None:
+            pending, self.pending = self.pending, []
+            for holder in pending:
+                if not self._splice(holder):
+                    self.nodes = None
+                    break
+
+        if self.nodes is None:
+            self._build()
+
+    def _build(self):
+        self.nodes = {}  # type -> nodes of this type, in document order
+        self.positions = {}  # type -> positions of these nodes
+        self.all_positions = []  # positions of all the nodes
+        self.spans = {}  # id(node) -> (position, position of the last node of its subtree)
+        self.children = {}  # id(node or root) -> its children, as indexed
+        # id(node) -> number of times the node is indexed, a node held in
+        # two places of the tree (see Node._held_by) is indexed twice
+        self.counts = {}
+        self.values = {}  # (type, key) -> value -> (positions, nodes)
+        self.pending = []
+
+        children = self._get_children(self.root)
+        self.children[id(self.root)] = children
+        self._insert(self._number(children, 0, None))
+
+    def _get_children(self, holder):
+        if holder is self.root:
+            return tuple(x for x in holder.data if isinstance(x, Node))
+        return tuple(holder._get_children())
+
+    def _number(self, nodes, low, high):
+        """
+        Give positions between low and high (excluded, None for no limit)
+        to the nodes of the subtrees of nodes, return the (position, node)
+        in document order or None if there isn't enough room
+        """
+        order = []
+        # index in order of the last node of the subtree of each node
+        lasts = []
+        # (node, None) to enter a node, (node, its index) to leave it
+        stack = [(x, None) for x in reversed(nodes)]
+        while stack:
+            node, index = stack.pop()
+            if index is not None:
+                lasts[index] = len(order) - 1
+                continue
+
+            stack.append((node, len(order)))
+            order.append(node)
+            lasts.append(None)
+            children = tuple(node._get_children())
+            self.children[id(node)] = children
+            stack.extend((x, None) for x in reversed(children))
+
+        step = self.GAP if high is None else min(self.GAP, (high - low) // (len(order) + 1))
+        if order and step < 1:
+            return None
+
+        added = []
+        for index, node in enumerate(order):
+            position = low + step * (index + 1)
+            self.spans[id(node)] = (position, low + step * (lasts[index] + 1))
+            self.counts[id(node)] = self.counts.get(id(node), 0) + 1
+            added.append((position, node))
+
+        return added
+
+    def _insert(self, added):
+        "Add the (position, node) of added, which follow each other in document order"
+        if not added:
+            return
+
+        index = bisect.bisect_left(self.all_positions, added[0][0])
+        self.all_positions[index:index] = [x for x, _ in added]
+
+        by_type = {}
+        for position, node in added:
+            positions, nodes = by_type.setdefault(node.type, ([], []))
+            positions.append(position)
+            nodes.append(node)
+
+        for node_type, (positions, nodes) in by_type.items():
+            type_positions = self.positions.setdefault(node_type, [])
+            type_nodes = self.nodes.setdefault(node_type, [])
+            index = bisect.bisect_left(type_positions, positions[0])
+            type_positions[index:index] = positions
+            type_nodes[index:index] = nodes
+
+            for (values_type, key), values in self.values.items():
+                if values_type != node_type:
+                    continue
+                for position, node in zip(positions, nodes):
+                    if key in node._str_keys:
+                        value_positions, value_nodes = values.setdefault(getattr(node, key), ([], []))
+                        index = bisect.bisect_left(value_positions, position)
+                        value_positions.insert(index, position)
+                        value_nodes.insert(index, node)
+
+    def _remove(self, low, high):
+        "Remove the nodes whose positions are between low and high (excluded, None for no limit)"
+        def bounds(positions):
+            start = bisect.bisect_right(positions, low)
+            end = len(positions) if high is None else bisect.bisect_left(positions, high, start)
+            return start, end
+
+        start, end = bounds(self.all_positions)
+        if start == end:
+            return
+        del self.all_positions[start:end]
+
+        for node_type, type_positions in self.positions.items():
+            start, end = bounds(type_positions)
+            if start == end:
+                continue
+
+            positions = type_positions[start:end]
+            nodes = self.nodes[node_type][start:end]
+            del type_positions[start:end]
+            del self.nodes[node_type][start:end]
+
+            for position, node in zip(positions, nodes):
+                count = self.counts.pop(id(node)) - 1
+                if count:
+                    self.counts[id(node)] = count
+                # a node moved without being removed from its old place
+                # is indexed twice, only forget this occurrence
+                if self.spans.get(id(node), (None,))[0] == position:
+                    del self.spans[id(node)]
+                    self.children.pop(id(node), None)
+
+            for values_key in [x for x in self.values if x[0] == node_type]:
+                self._remove_values(values_key, positions, nodes)
+
+    def _remove_values(self, values_key, positions, nodes):
+        values = self.values[values_key]
+        key = values_key[1]
+        for position, node in zip(positions, nodes):
+            if key not in node._str_keys:
+                continue
+
+            value = getattr(node, key)
+            value_positions, value_nodes = values.get(value, ((), ()))
+            index = bisect.bisect_left(value_positions, position)
+            if index == len(value_positions) or value_positions[index] != position:
+                # indexed under another value, index it again on the next
+                # query filtering on it
+                del self.values[values_key]
+                return
+
+            del value_positions[index]
+            del value_nodes[index]
+            if not value_positions:
+                del values[value]
+
+    def _splice(self, holder):
+        """
+        Update the index after the children of holder (a node or the root)
+        have changed, return False if it has to be rebuilt instead
+
+        Only the children between the first and the last one that have
+        changed are removed from the index, the new ones are then given
+        positions between the ones of their unchanged neighbours.
+        """
+        old = self.children.get(id(holder))
+        if old is None:
+            # not in the tree anymore
+            return True
+
+        new = self._get_children(holder)
+        limit = min(len(old), len(new))
+        prefix = 0
+        while prefix < limit and old[prefix] is new[prefix]:
+            prefix += 1
+        if prefix == len(old) == len(new):
+            return True
+        suffix = 0
+        while suffix < limit - prefix and old[-1 - suffix] is new[-1 - suffix]:
+            suffix += 1
+
+        neighbours = [old[prefix - 1]] if prefix else []
+        if suffix:
+            neighbours.append(old[-suffix])
+        if holder is not self.root:
+            neighbours.append(holder)
+        if any(id(x) not in self.spans for x in neighbours):
+            return False
+
+        if holder is self.root:
+            position, last = 0, None
+        else:
+            position, last = self.spans[id(holder)]
+
+        low = self.spans[id(old[prefix - 1])][1] if prefix else position
+        if suffix:
+            high = self.spans[id(old[-suffix])][0]
+        elif last is None:
+            high = None
+        else:
+            index = bisect.bisect_right(self.all_positions, last)
+            high = self.all_positions[index] if index < len(self.all_positions) else None
 
-        return next((pos, key) for pos, (_, key, _) in enumerate(parent._render()) if key == node.on_attribute)
+        self._remove(low, high)
+        added = self._number(new[prefix:len(new) - suffix], low, high)
+        if added is None:
+            return False
+        self._insert(added)
+        self.children[id(holder)] = new
+
+        if not suffix and last is not None:
+            new_last = self.spans[id(new[-1])][1] if new else position
+            self._set_last(holder, last, new_last)
+
+        return True
+
+    def _set_last(self, node, old_last, new_last):
+        "Set the last position of the subtree of node and of its ancestors ending at the same node"
+        while isinstance(node, Node):
+            span = self.spans.get(id(node))
+            if span is None or span[1] != old_last:
+                return
+            self.spans[id(node)] = (span[0], new_last)
+            node = node.parent
+
+    def get_values(self, node_type, key):
+        "Return the values index of this string attribute of this type"
+        values = self.values.get((node_type, key))
+        if values is None:
+            values = {}
+            for position, node in zip(self.positions[node_type], self.nodes[node_type]):
+                if key in node._str_keys:
+                    positions, nodes = values.setdefault(getattr(node, key), ([], []))
+                    positions.append(position)
+                    nodes.append(node)
+            self.values[(node_type, key)] = values
+
+        return values
+
+    def set_value(self, node, key, old_value):
+        "Update the values index after the string attribute key of node has been set"
+        if self.nodes is None:
+            return
+
+        if key == "type":
+            self.nodes = None
+            self.pending = []
+            return
+
+        span = self.spans.get(id(node))
+        values = self.values.get((node.type, key))
+        if span is None or values is None:
+            # not indexed yet or not indexed by this key
+            return
+
+        if self.counts[id(node)] > 1:
+            # only the position of one of its occurrences is known, index
+            # the values again on the next query filtering on them
+            del self.values[(node.type, key)]
+            return
+
+        position = span[0]
+        positions, nodes = values.get(old_value, ((), ()))
+        index = bisect.bisect_left(positions, position)
+        if index == len(positions) or positions[index] != position:
+            del self.values[(node.type, key)]
+            return
+
+        del positions[index]
+        del nodes[index]
+        if not positions:
+            del values[old_value]
+
+        positions, nodes = values.setdefault(getattr(node, key), ([], []))
+        index = bisect.bisect_left(positions, position)
+        positions.insert(index, position)
+        nodes.insert(index, node)
+
+    def find_all(self, identifier, node=None, kwargs=None):
+        """
+        Return the nodes of the subtree of node (included, the whole tree
+        by default) that match identifier, in document order, or None if
+        node isn't in the index
+
+        If kwargs has a string (or int) value, only the nodes having this
+        value are returned, the other entries of kwargs aren't checked.
+        """
+        self.update()
+
+        span = (0, None) if node is None else self.spans.get(id(node))
+        if span is None:
+            return None
+
+        # other nodes than the ones with string attributes can't be equal
+        # to a string, see get_values
+        key = next((x for x in sorted(kwargs or {}) if isinstance(kwargs[x], (string_instance, int))), None)
+
+        start, last = span
+        found = []
+        for node_type in [x for x in get_node_types(identifier) if x in self.nodes]:
+            if key is None:
+                positions, nodes = self.positions[node_type], self.nodes[node_type]
+            else:
+                positions, nodes = self.get_values(node_type, key).get(kwargs[key], ((), ()))
+
+            low = bisect.bisect_left(positions, start)
+            high = len(positions) if last is None else bisect.bisect_right(positions, last, low)
+            found.append(list(zip(positions[low:high], nodes[low:high])))
+
+        if len(found) == 1:
+            return [x for _, x in found[0]]
+
+        # positions are unique, the nodes themselves are never compared
+        return [x for _, x in sorted(itertools.chain.from_iterable(found), key=lambda x: x[0])]
+
+
+class Selector(object):
+    """A compiled selector, like "class[name=Foo] > def call"
+
+    A selector is a list of queries separated by combinators: a space means
+    "somewhere under", ">" means "directly under" (in the tree walked by
+    find_all, i.e. ignoring the NodeLists). A query is an identifier like
+    in find_all ("*" matches every node) followed by any number of
+    [key=value] filters, the value can be quoted.
+
+    The whole selector is evaluated in a single walk of the tree: each node
+    gets the set of the queries that its ancestors already satisfied.
+    """
+    TOKENS = re.compile(r"""(?P<space>\s+)|(?P<query>\*|\w+)|(?P<child>>)|\[\s*(?P<key>\w+)\s*=\s*(?:"(?P<dquoted>[^"]*)"|'(?P<squoted>[^']*)'|(?P<value>[^\]\s]+))\s*\]""")
+    DESCENDANT, CHILD = range(2)
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.queries = []  # (types or None for "*", kwargs)
+        self.combinators = []  # combinator before each query
+
+        # combinator found since the last query, None if there is none yet
+        combinator = None
+        position = 0
+        while position < len(selector):
+            match = self.TOKENS.match(selector, position)
+            if match is None:
+                raise ValueError("Invalid selector %r at position %s" % (selector, position))
+
+            if match.group("space"):
+                if self.queries and combinator is None:
+                    combinator = self.DESCENDANT
+
+            elif match.group("child"):
+                if not self.queries or combinator == self.CHILD:
+                    raise ValueError("Invalid selector %r at position %s" % (selector, position))
+                combinator = self.CHILD
+
+            elif match.group("query"):
+                if self.queries and combinator is None:
+                    raise ValueError("Invalid selector %r at position %s" % (selector, position))
+                identifier = match.group("query")
+                self.queries.append((None if identifier == "*" else get_node_types(identifier), {}))
+                self.combinators.append(combinator if combinator is not None else self.DESCENDANT)
+                combinator = None
+
+            else:
+                if not self.queries or combinator is not None:
+                    raise ValueError("Invalid selector %r at position %s" % (selector, position))
+                value = [x for x in match.group("dquoted", "squoted", "value") if x is not None][0]
+                self.queries[-1][1][match.group("key")] = value
+
+            position = match.end()
+
+        if not self.queries or combinator == self.CHILD:
+            raise ValueError("Invalid selector %r" % selector)
+
+        self.last = 1 << (len(self.queries) - 1)
+        # queries that can be satisfied anywhere under the previous one
+        self.descendant_mask = sum(1 << x for x, combinator in enumerate(self.combinators) if combinator == self.DESCENDANT)
+
+    def __repr__(self):
+        return "Selector(%r)" % self.selector
+
+    def _matches(self, node, candidates):
+        "Return the mask of the queries among candidates that node satisfies"
+        matched = 0
+        for position, (types, kwargs) in enumerate(self.queries):
+            bit = 1 << position
+            if candidates & bit and (types is None or node.type in types) and node._match(kwargs):
+                matched |= bit
+        return matched
+
+    def select_iter(self, root, limit=None):
+        "Yield the nodes of root (a node or a node list) matching the selector in document order"
+        return itertools.islice(self._select_iter(root), limit)
+
+    def _select_iter(self, root):
+        # (node, mask of the queries satisfied by its parent, mask of the
+        # queries that can be satisfied because of an older ancestor)
+        stack = [(x, 0, 0) for x in reversed(root.data if isinstance(root, NodeList) else [root])]
+        while stack:
+            node, parent_matched, inherited = stack.pop()
+            # the first query can be satisfied anywhere
+            matched = self._matches(node, 1 | (parent_matched << 1) | inherited)
+            if matched & self.last:
+                yield node
+
+            inherited |= (matched << 1) & self.descendant_mask
+            children = node._get_children()
+            children.reverse()
+            stack.extend((x, matched, inherited) for x in children)
+
+    def select(self, root):
+        return NodeList(self._select_iter(root))
+
+
+class Visitor(object):
+    """Run many queries in a single walk of the tree
+
+    Callbacks are registered for an identifier (like in find_all, with the
+    same keyword arguments filters, "*" for every node) and are called with
+    each matching node, in document order, when visit() walks the tree:
+
+        visitor = Visitor()
+        visitor.register("def", check_function)
+        visitor.register("name", check_logger, value="logger")
+        visitor.register_post("class", leave_class)
+        visitor.visit(red)
+
+    The callbacks registered with register() are called before the
+    children of the node are visited, if one of them returns Visitor.SKIP
+    its children aren't visited at all. The ones registered with
+    register_post() are called after.
+    """
+    SKIP = object()
+
+    def __init__(self):
+        # type -> [(callback, kwargs)] in registration order
+        self.handlers = {}
+        self.post_handlers = {}
+
+    def _register(self, handlers, identifier, callback, kwargs):
+        types = node_schemas if identifier == "*" else get_node_types(identifier)
+        for node_type in types:
+            handlers.setdefault(node_type, []).append((callback, kwargs))
+
+    def register(self, identifier, callback, **kwargs):
+        self._register(self.handlers, identifier, callback, kwargs)
+
+    def register_post(self, identifier, callback, **kwargs):
+        self._register(self.post_handlers, identifier, callback, kwargs)
+
+    def visit(self, root):
+        "Walk root (a node or a node list) and call the registered callbacks"
+        handlers = self.handlers
+        post_handlers = self.post_handlers
+
+        # (node, are its children already visited)
+        stack = [(x, False) for x in reversed(root.data if isinstance(root, NodeList) else [root])]
+        while stack:
+            node, leaving = stack.pop()
+            if leaving:
+                for callback, kwargs in post_handlers[node.type]:
+                    if node._match(kwargs):
+                        callback(node)
+                continue
+
+            skip = False
+            for callback, kwargs in handlers.get(node.type, ()):
+                if node._match(kwargs) and callback(node) is self.SKIP:
+                    skip = True
+
+            if node.type in post_handlers:
+                stack.append((node, True))
+
+            if not skip:
+                children = node._get_children()
+                children.reverse()
+                stack.extend((x, False) for x in children)
+
+
+class NodeSchema(object):
+    """Precomputed description of a baron node type
+
+    Everything that only depends on the type of a node (which keys are
+    strings, lists or nodes) is computed once here instead of for every
+    node instance. build() is a specialized constructor that fills the
+    attributes of a node directly, without going through
+    Node.__setattr__.
+
+    In lazy mode, only the strings are set: the nodes and node lists are
+    built from the raw FST, which is kept on the node, on first access
+    (see Node.__getattr__).
+    """
+    STR, LIST, KEY = range(3)
+
+    def __init__(self, node_type):
+        self.type = node_type
+        self.steps = []
+        self.formatting_keys = set()
+        for kind, key, _ in nodes_rendering_order[node_type]:
+            if kind == "constant":
+                continue
+            elif kind == "bool":
+                self.steps.append((key, self.STR))
+            elif kind in ("list", "formatting"):
+                self.steps.append((key, self.LIST))
+                if kind == "formatting":
+                    self.formatting_keys.add(key)
+            elif kind == "key":
+                # "key" can either hold a string or a node (or nothing),
+                # this can only be decided on the content of the node
+                self.steps.append((key, self.KEY))
+            else:
+                raise Exception(str((node_type, kind, key)))
+
+        self.steps = tuple(self.steps)
+        self.formatting_keys = frozenset(self.formatting_keys)
+        # the entries of the rendering order that can be rendered, see
+        # Node._dump (the other ones are always skipped by baron)
+        self.render_steps = tuple((kind, key, dependent) for kind, key, dependent in nodes_rendering_order[node_type] if dependent)
+        # key -> position in the rendering order, used by Path
+        self.render_positions = {}
+        for position, (_, key, _) in enumerate(nodes_rendering_order[node_type]):
+            self.render_positions.setdefault(key, position)
+        # (str keys, list keys, dict keys) indexed by the kind of each "key"
+        self._keys_by_shape = {}
+
+    def get_keys(self, shape):
+        """
+        Return the shared (str keys, list keys, dict keys, child keys)
+        tuples for this shape
+
+        The child keys are the keys that can hold the children of the node
+        for a query, in rendering order: the lists (but not the formatting
+        ones, which only hold spaces, comments and endls) and the keys
+        holding a node. Queries don't look at the other keys at all.
+        """
+        keys = self._keys_by_shape.get(shape)
+        if keys is None:
+            str_keys, list_keys, dict_keys, child_keys = ["type"], [], [], []
+            key_is_str = iter(shape)
+            for key, kind in self.steps:
+                if kind == self.LIST:
+                    list_keys.append(key)
+                    if key not in self.formatting_keys:
+                        child_keys.append(key)
+                elif kind == self.STR or next(key_is_str):
+                    str_keys.append(key)
+                else:
+                    dict_keys.append(key)
+                    child_keys.append(key)
+
+            keys = (tuple(str_keys), tuple(list_keys), tuple(dict_keys), tuple(child_keys))
+            self._keys_by_shape[shape] = keys
+
+        return keys
+
+    def build(self, instance, node, parent, on_attribute, lazy=False):
+        setattr_ = object.__setattr__
+        setattr_(instance, "parent", parent)
+        setattr_(instance, "on_attribute", on_attribute)
+        setattr_(instance, "type", self.type)
+        setattr_(instance, "_position", None)
+        setattr_(instance, "_indentation_cache", None)
+        setattr_(instance, "_path_cache", None)
+        setattr_(instance, "_hash_cache", None)
+        setattr_(instance, "_dump_cache", None)
+        setattr_(instance, "_other_holders", None)
+
+        shape = []
+        for key, kind in self.steps:
+            value = node[key]
+            if kind == self.LIST:
+                if not lazy:
+                    setattr_(instance, key, self.build_list(instance, key, value))
+
+            elif kind == self.STR:
+                setattr_(instance, key, value)
+
+            elif isinstance(value, string_instance):
+                setattr_(instance, key, value)
+                shape.append(True)
+
+            elif isinstance(value, (dict, BinaryDict, type(None))):
+                if not value:
+                    setattr_(instance, key, None)
+                elif not lazy:
+                    setattr_(instance, key, to_node(value, parent=instance, on_attribute=key))
+                shape.append(False)
+
+            else:
+                raise Exception(str((self.type, kind, key)))
+
+        setattr_(instance, "_fst", node if lazy else None)
+
+        setattr_(instance, "_keys", self.get_keys(tuple(shape)))
+
+    def build_list(self, instance, key, value, lazy=False):
+        node_list = NodeList(parent=instance)
+        node_list.data = [to_node(x, parent=instance, on_attribute=key, lazy=lazy) for x in value]
+        return node_list
+
+    def materialize(self, instance, key):
+        "Build the attribute 'key' of a lazy node from its raw FST"
+        value = instance._fst[key]
+        if key in instance._list_keys:
+            value = self.build_list(instance, key, value, lazy=True)
+        else:
+            value = to_node(value, parent=instance, on_attribute=key, lazy=True)
+
+        object.__setattr__(instance, key, value)
+        return value
 
 
 class GenericNodesUtils(object):
     # XXX should this be an abstract class?
+    __slots__ = ()
+
+    def _get_root(self):
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        return root
+
+    def _changed(self):
+        "Must be called after each modification of the tree, see RedBaron._version"
+        for root in self._clear_caches():
+            root._version += 1
+            if root._index is not None:
+                root._index.changed(self)
+
+    def _clear_caches(self, roots=None):
+        """
+        Forget the structural hash and the source code of this node and of
+        its ancestors (see Node._structural_hash and Node._dump) and return
+        the RedBaron instances at the root of the trees holding it
+
+        The ancestors reached through the other holders of a node (see
+        Node._held_by) are cleared too, a node can be in several trees.
+        """
+        if roots is None:
+            roots = []
+
+        current = self
+        while True:
+            if isinstance(current, Node):
+                object.__setattr__(current, "_hash_cache", None)
+                object.__setattr__(current, "_dump_cache", None)
+                if current._other_holders is not None:
+                    for holder in current._other_holders:
+                        holder._clear_caches(roots)
+            if current.parent is None:
+                break
+            current = current.parent
+
+        if isinstance(current, RedBaron) and not any(x is current for x in roots):
+            roots.append(current)
+        return roots
+
+    def select(self, selector):
+        """
+        Return the nodes matching the selector (a string or a Selector),
+        e.g. red.select("class[name=Foo] > def call")
+        """
+        if not isinstance(selector, Selector):
+            selector = Selector(selector)
+        return selector.select(self)
+
+    def _get_index(self):
+        "Return the NodeIndex of the tree of this node if it has one"
+        root = self._get_root()
+        return root._index if isinstance(root, RedBaron) else None
+
     def _convert_input_to_node_object(self, value, parent, on_attribute):
         if isinstance(value, string_instance):
             return to_node(baron.parse(value)[0], parent=parent, on_attribute=on_attribute)
         elif isinstance(value, dict):
             return to_node(value, parent=parent, on_attribute=on_attribute)
         elif isinstance(value, Node):
-            value.parent = parent
-            value.on_attribute = on_attribute
+            value._reparent(parent, on_attribute)
             return value
 
         raise NotImplemented
 
     def _convert_input_to_node_object_list(self, value, parent, on_attribute):
         if isinstance(value, string_instance):
-            return NodeList(map(lambda x: to_node(x, parent=parent, on_attribute=on_attribute), baron.parse(value)))
+            return NodeList(map(lambda x: to_node(x, parent=parent, on_attribute=on_attribute), baron.parse(value)), parent=parent)
 
         if isinstance(value, dict):  # assuming that we got some fst
                                      # also assuming the user do strange things
-            return NodeList([to_node(value, parent=parent, on_attribute=on_attribute)])
+            return NodeList([to_node(value, parent=parent, on_attribute=on_attribute)], parent=parent)
 
         if isinstance(value, Node):
-            value.parent = parent
-            value.on_attribute = on_attribute
-            return [value]
+            value._reparent(parent, on_attribute)
+            return NodeList([value], parent=parent)
 
         if isinstance(value, list) and not isinstance(value, NodeList):
             # assume the user can pass a list of random stuff
-            new_value = NodeList()
+            new_value = NodeList(parent=parent)
             for i in value:
                 new_value.append(self._convert_input_to_node_object(i, parent, on_attribute))
 
@@ -167,26 +1368,261 @@ class NodeList(UserList, GenericNodesUtils):
     # avoid common bug in shell by providing None
     next = None
     previous = None
+    parent = None
+    on_attribute = None
+    # incremented on every modification of the list itself
+    _list_version = 0
+    # {id(node): position}, see _index_of
+    _positions_cache = None
 
     def __init__(self, initlist=None, parent=None, on_attribute=None):
         super(NodeList, self).__init__(initlist)
         self.parent = parent
         self.on_attribute = on_attribute
 
+    # every modification of the list has to be notified, see _changed
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            self._adopt(value)
+            self.data[index] = value
+            self._positions_cache = None
+        else:
+            self._adopt([value])
+            index = self._normalize_index(index)
+            removed = self.data[index]
+            self.data[index] = value
+            self._update_positions(index, index + 1, [removed])
+        self._changed()
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            del self.data[index]
+            self._positions_cache = None
+        else:
+            index = self._normalize_index(index)
+            removed = self.data.pop(index)
+            self._update_positions(index, None, [removed])
+        self._changed()
+
+    # python 2 doesn't go through __setitem__ and __delitem__ for simple
+    # slices, these are never called on python 3
+    def __setslice__(self, i, j, other):
+        other = list(other)
+        self._adopt(other)
+        super(NodeList, self).__setslice__(i, j, other)
+        self._positions_cache = None
+        self._changed()
+
+    def __delslice__(self, i, j):
+        super(NodeList, self).__delslice__(i, j)
+        self._positions_cache = None
+        self._changed()
+
+    def __iadd__(self, other):
+        other = list(other)
+        self._adopt(other)
+        start = len(self.data)
+        to_return = super(NodeList, self).__iadd__(other)
+        self._update_positions(start, None, [])
+        self._changed()
+        return to_return
+
+    def __imul__(self, n):
+        to_return = super(NodeList, self).__imul__(n)
+        self._positions_cache = None
+        self._changed()
+        return to_return
+
+    def append(self, item):
+        self._adopt([item])
+        self._insert_item(len(self.data), item)
+        self._changed()
+
+    def insert(self, index, item):
+        self._adopt([item])
+        self._insert_item(index, item)
+        self._changed()
+
+    def pop(self, index=-1):
+        index = self._normalize_index(index)
+        to_return = self.data.pop(index)
+        self._update_positions(index, None, [to_return])
+        self._changed()
+        return to_return
+
+    # nodes are compared by identity, see _index_of
+    def remove(self, item):
+        if isinstance(item, Node):
+            position = self._index_of(item)
+            if position is None:
+                raise ValueError("NodeList.remove(x): x not in list")
+        else:
+            position = self.data.index(item)
+        del self.data[position]
+        self._update_positions(position, None, [item])
+        self._changed()
+
+    def index(self, item, start=0, stop=sys.maxsize):
+        if not isinstance(item, Node):
+            return self.data.index(item, start, stop)
+
+        position = self._index_of(item)
+        if position is None or position not in range(len(self.data))[start:stop]:
+            raise ValueError("%r is not in list" % item)
+        return position
+
+    def __contains__(self, item):
+        if not isinstance(item, Node):
+            return item in self.data
+        return self._index_of(item) is not None
+
+    def count(self, item):
+        if not isinstance(item, Node):
+            return self.data.count(item)
+        return sum(1 for x in self.data if x is item)
+
+    def clear(self):
+        del self.data[:]
+        self._positions_cache = None
+        self._changed()
+
+    def reverse(self):
+        self.data.reverse()
+        self._positions_cache = None
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        self.data.sort(*args, **kwargs)
+        self._positions_cache = None
+        self._changed()
+
+    def extend(self, other):
+        other = list(other)
+        self._adopt(other)
+        start = len(self.data)
+        self.data.extend(other)
+        self._update_positions(start, None, [])
+        self._changed()
+
+    def _changed(self):
+        self._list_version += 1
+        super(NodeList, self)._changed()
+
+    def _adopt(self, items):
+        "Note that the nodes of items are now held by this list, see Node._held_by"
+        # the nodes of a RedBaron instance have it as parent, the ones of
+        # the other lists have the parent of the list
+        holder = self if self.parent is None else self.parent
+        for item in items:
+            if isinstance(item, Node):
+                item._held_by(holder)
+
+    def _structural_hash(self):
+        "Return a hash of the content of the list, see Node._structural_hash"
+        return hash(tuple(x._structural_hash() if isinstance(x, Node) else x for x in self.data))
+
+    def _normalize_index(self, index):
+        "Return the positive position of an existing item, like list.pop"
+        if index < 0:
+            index += len(self.data)
+        if not 0 <= index < len(self.data):
+            raise IndexError("list index out of range")
+        return index
+
+    def _insert_item(self, index, item):
+        "Insert item in .data like list.insert and keep the positions up to date"
+        length = len(self.data)
+        if index < 0:
+            index = max(index + length, 0)
+        index = min(index, length)
+        self.data.insert(index, item)
+        self._update_positions(index, None, [])
+
+    def _index_of(self, node):
+        """
+        Return the position of node in the list (comparing by identity) or
+        None if it isn't in the list
+
+        The position stored on the node (see Node._position) is used if it
+        is right. Otherwise the position is taken from a map id(node) ->
+        position, built on first use, which the modifications of the list
+        keep up to date along with the positions stored on the nodes held
+        by this list (see _update_positions).
+        """
+        data = self.data
+        position = node._position
+        if position is not None and position < len(data) and data[position] is node:
+            return position
+
+        positions = self._positions_cache
+        if positions is None:
+            positions = self._build_positions_cache()
+
+        position = positions.get(id(node))
+        if position is None or position >= len(data) or data[position] is not node:
+            # .data has been modified directly
+            position = self._build_positions_cache().get(id(node))
+
+        return position
+
+    def _build_positions_cache(self):
+        self._positions_cache = {}
+        self._update_positions(0, None, [])
+        return self._positions_cache
+
+    def _update_positions(self, start, stop, removed):
+        """
+        Update the positions after the items of removed have been removed
+        and the items from start to stop (the end of the list for None)
+        have been added or moved
+
+        Only these items are looked at, so adding or removing an item at
+        the end of the list doesn't go through the whole list.
+        """
+        data = self.data
+        stop = len(data) if stop is None else stop
+        # the nodes of a RedBaron instance have it as parent, the ones of
+        # the other lists have the parent of the list
+        holder = self if self.parent is None else self.parent
+        for position in range(stop - 1, start - 1, -1):
+            item = data[position]
+            if isinstance(item, Node) and item.parent is holder:
+                object.__setattr__(item, "_position", position)
+
+        positions = self._positions_cache
+        if positions is None:
+            return
+
+        for item in removed:
+            positions.pop(id(item), None)
+
+        for position in range(stop - 1, start - 1, -1):
+            item = data[position]
+            old = positions.get(id(item))
+            # an item in the list twice keeps its first position
+            if old is not None and old < start and old < len(data) and data[old] is item:
+                continue
+            positions[id(item)] = position
+
+    def find_iter(self, identifier, recursive=True, limit=None, **kwargs):
+        "Yield the nodes matching the query in document order, see Node.find_iter"
+        found = itertools.chain.from_iterable(x.find_iter(identifier, recursive, **kwargs) for x in self.data)
+        return itertools.islice(found, limit)
+
     def find(self, identifier, recursive=True, **kwargs):
-        for i in self.data:
-            candidate = i.find(identifier, recursive=recursive, **kwargs)
-            if candidate is not None:
-                return candidate
+        return next(self.find_iter(identifier, recursive, limit=1, **kwargs), None)
 
     def __getattr__(self, key):
+        if key.startswith("_"):
+            # never do a query for private or special attributes, otherwise
+            # things like pickle or copy end up in an infinite recursion
+            raise AttributeError(key)
+
         return self.find(key)
 
     def find_all(self, identifier, recursive=True, **kwargs):
-        to_return = NodeList([])
-        for i in self.data:
-            to_return += i.find_all(identifier, recursive=recursive, **kwargs)
-        return to_return
+        return NodeList(self.find_iter(identifier, recursive, **kwargs))
 
     findAll = find_all
     __call__ = find_all
@@ -194,6 +1630,9 @@ class NodeList(UserList, GenericNodesUtils):
     def find_by_path(self, path):
         return Path.from_baron_path(self, path).node
 
+    def find_by_paths(self, paths):
+        return [x.node for x in Path.from_baron_paths(self, paths)]
+
     def path(self):
         return Path(self)
 
@@ -201,7 +1640,17 @@ class NodeList(UserList, GenericNodesUtils):
         return [x.fst() for x in self.data]
 
     def dumps(self):
-        return baron.dumps(self.fst())
+        parts = []
+        self._dump(parts)
+        return "".join(parts)
+
+    def _dump(self, parts):
+        "Append the source code of the list to parts, see Node._dump"
+        for x in self.data:
+            if isinstance(x, string_instance):
+                parts.append(x)
+            else:
+                x._dump(parts)
 
     def __repr__(self):
         to_return = ""
@@ -219,9 +1668,14 @@ class NodeList(UserList, GenericNodesUtils):
     def __help__(self, deep=2, with_formatting=False):
         return [x.__help__(deep=deep, with_formatting=with_formatting) for x in self.data]
 
-    def copy(self):
-        # XXX not very optimised but at least very simple
-        return NodeList(map(to_node, self.fst()))
+    def copy(self, share_formatting=False):
+        "Return a copy of the nodes, see Node.copy"
+        return NodeList([x._clone(None, None, share_formatting) for x in self.data])
+
+    def _clone(self, parent, on_attribute, share_formatting):
+        clone = NodeList(parent=parent, on_attribute=self.on_attribute)
+        clone.data = [x._clone(parent, on_attribute, share_formatting) for x in self.data]
+        return clone
 
     def next_generator(self):
         # similary, NodeList will never have next items
@@ -256,110 +1710,176 @@ class NodeList(UserList, GenericNodesUtils):
             comma = self.comma.copy()
             comma.parent = parent
             comma.on_attribute = on_attribute
-            self.data.append(comma)
+            self._insert_item(len(self.data), comma)
 
         elif self.find("comma", recursive=False) and self.data[-1].type == "comma":
             self.data[-1].second_formatting = {"type": "space", "value": " "}
 
         elif len(self.data) != 0:
-            self.data.append(to_node({"type": "comma", "first_formatting": [], "second_formatting": [{"type": "space", "value": " "}]}, parent=parent, on_attribute=on_attribute))
+            self._insert_item(len(self.data), to_node({"type": "comma", "first_formatting": [], "second_formatting": [{"type": "space", "value": " "}]}, parent=parent, on_attribute=on_attribute))
 
-        self.data.append(self._convert_input_to_node_object(value, parent, on_attribute))
+        self._insert_item(len(self.data), self._convert_input_to_node_object(value, parent, on_attribute))
 
         if trailing:
-            self.data.append(to_node({"type": "comma", "first_formatting": [], "second_formatting": []}, parent=parent, on_attribute=on_attribute))
+            self._insert_item(len(self.data), to_node({"type": "comma", "first_formatting": [], "second_formatting": []}, parent=parent, on_attribute=on_attribute))
+
+        self._changed()
 
     def append_endl(self, value, parent, on_attribute):
         "Generic function to append a value in a separated by endl list"
-        if self.filtered()[-1].indentation_node_is_direct() is False:
+        # same as self.filtered()[-1] without going through the whole list
+        last = next((x for x in reversed(self.data) if not isinstance(x, (EndlNode, CommaNode, DotNode))), None)
+        if last is None:
+            raise IndexError("Can't append to a list without any statement")
+
+        if last.indentation_node_is_direct() is False:
             # we are in this kind of case: while a: pass
-            self.data.insert(0, to_node({
-                "indent": self.filtered()[-1].indentation + "    ",
+            self._insert_item(0, to_node({
+                "indent": last.indentation + "    ",
                 "formatting": [],
                 "type": "endl",
                 "value": "\n",
             }, parent=parent, on_attribute=on_attribute))
+            self._changed()
 
-        if not (self.data[-2].type == "endl" and self.data[-2].indent == self.filtered()[-1].get_indentation_node().indent):
-            new_endl_node = self.filtered()[-1].get_indentation_node().copy()
+        indentation_node = last.get_indentation_node()
+        if not (self.data[-2].type == "endl" and self.data[-2].indent == indentation_node.indent):
+            new_endl_node = indentation_node.copy()
             new_endl_node.parent = parent
             new_endl_node.on_attribute = on_attribute
-            self.data.insert(-1, new_endl_node)
+            self._insert_item(-1, new_endl_node)
 
-        self.data.insert(-1, self._convert_input_to_node_object(value, parent=parent, on_attribute=on_attribute))
+        self._insert_item(-1, self._convert_input_to_node_object(value, parent=parent, on_attribute=on_attribute))
+        self._changed()
 
 
-class Node(GenericNodesUtils):
-    _other_identifiers = []
+class NodeMeta(type):
+    """Metaclass of the nodes
 
-    def __init__(self, node, parent=None, on_attribute=None):
-        self.init = True
-        self.parent = parent
-        self.on_attribute = on_attribute
-        self._str_keys = ["type"]
-        self._list_keys = []
-        self._dict_keys = []
-        self.type = node["type"]
-        for kind, key, _ in filter(lambda x: x[0] != "constant", self._render()):
-            if kind == "key" and isinstance(node[key], (dict, type(None))):
-                if node[key]:
-                    setattr(self, key, to_node(node[key], parent=self, on_attribute=key))
-                else:
-                    setattr(self, key, None)
-                self._dict_keys.append(key)
+    Nodes don't have a __dict__, the classes representing a baron type get
+    a __slots__ derived from the keys of this type in
+    nodes_rendering_order.
+    """
+    def __new__(meta, name, bases, attributes):
+        if "__slots__" not in attributes and name in node_types_by_class_name:
+            inherited = set()
+            for base in bases:
+                inherited.update(getattr(base, "_all_slots", ()))
 
-            elif kind == "bool" or (kind == "key" and isinstance(node[key], string_instance)):
-                setattr(self, key, node[key])
-                self._str_keys.append(key)
+            keys = node_keys(node_types_by_class_name[name])
+            attributes["__slots__"] = tuple(x for x in keys if x not in inherited)
 
-            elif kind in ("list", "formatting"):
-                setattr(self, key, NodeList(map(lambda x: to_node(x, parent=self, on_attribute=key), node[key]), parent=self))
-                self._list_keys.append(key)
+        klass = super(NodeMeta, meta).__new__(meta, name, bases, attributes)
+        klass._all_slots = tuple(x for base in reversed(klass.__mro__) for x in base.__dict__.get("__slots__", ()))
+        return klass
 
-            else:
-                raise Exception(str((node["type"], kind, key)))
 
-        self.init = False
+def node_keys(node_type):
+    "Return the keys (in rendering order) of a baron type"
+    keys = []
+    for kind, key, _ in nodes_rendering_order[node_type]:
+        if kind != "constant" and key not in keys:
+            keys.append(key)
+    return keys
 
-    @property
-    def next(self):
+
+node_types_by_class_name = dict((node_class_name(x), x) for x in nodes_rendering_order)
+
+
+# python 2 and 3 don't have the same syntax for metaclasses
+_NodeBase = NodeMeta("_NodeBase", (GenericNodesUtils,), {"__slots__": ()})
+
+
+class Node(_NodeBase):
+    # _position is the position of the node in the NodeList holding it,
+    # only as a hint, see NodeList._index_of
+    # _indentation_cache is (list, its _list_version, last endl node before
+    # me in this list), see _get_preceding_endl
+    # _path_cache is (root, root._version, baron path), see Path.set_node
+    # _hash_cache is the structural hash of the node, see _structural_hash
+    # _dump_cache is the source code of the node, see _dump
+    # _other_holders are the nodes (or node lists) that also hold this
+    # node, other than its parent, see _held_by
+    __slots__ = ("parent", "on_attribute", "type", "_keys", "_fst", "_position", "_indentation_cache", "_path_cache", "_hash_cache", "_dump_cache", "_other_holders")
+
+    _other_identifiers = []
+
+    def __init__(self, node, parent=None, on_attribute=None, lazy=False):
+        node_schemas[node["type"]].build(self, node, parent, on_attribute, lazy=lazy)
+
+    def _get_position(self):
+        "Return (list holding this node, position in it) or (None, None)"
         in_list = self._get_list_attribute_is_member_off()
 
         if in_list is None:
+            return None, None
+
+        position = in_list._index_of(self)
+        return (in_list, position) if position is not None else (None, None)
+
+    @property
+    def next(self):
+        in_list, position = self._get_position()
+
+        if in_list is None or position + 1 >= len(in_list.data):
             return None
 
-        next_node = list(itertools.dropwhile(lambda x: x is not self, in_list))[1:]
-        return next_node[0] if next_node else None
+        return in_list.data[position + 1]
 
     def next_generator(self):
-        in_list = self._get_list_attribute_is_member_off()
+        in_list, position = self._get_position()
 
         if in_list is None:
             return None
 
-        generator = itertools.dropwhile(lambda x: x is not self, in_list)
-        next(generator)
-        return generator
+        return self._iter_siblings(in_list.data, position + 1, 1)
 
     @property
     def previous(self):
-        in_list = self._get_list_attribute_is_member_off()
+        in_list, position = self._get_position()
 
-        if in_list is None:
+        if in_list is None or position == 0:
             return None
 
-        next_node = list(itertools.dropwhile(lambda x: x is not self, reversed(in_list)))[1:]
-        return next_node[0] if next_node else None
+        return in_list.data[position - 1]
 
     def previous_generator(self):
-        in_list = self._get_list_attribute_is_member_off()
+        in_list, position = self._get_position()
 
         if in_list is None:
             return None
 
-        generator = itertools.dropwhile(lambda x: x is not self, reversed(in_list))
-        next(generator)
-        return generator
+        return self._iter_siblings(in_list.data, position - 1, -1)
+
+    @staticmethod
+    def _iter_siblings(data, position, step):
+        while 0 <= position < len(data):
+            yield data[position]
+            position += step
+
+    def _reparent(self, parent, on_attribute):
+        """
+        Move this node under parent, its old parent can still hold it (the
+        node is then in two places of the tree), see _held_by
+        """
+        old_parent = self.parent
+        self.parent = parent
+        self.on_attribute = on_attribute
+        if old_parent is not None:
+            self._held_by(old_parent)
+
+    def _held_by(self, holder):
+        """
+        Note that holder (a node or a node list) holds this node although it
+        isn't its parent, so modifying the node also forgets the caches of
+        holder and of its ancestors (see _clear_caches)
+        """
+        if holder is self.parent:
+            return
+
+        others = self._other_holders or ()
+        if not any(x is holder for x in others):
+            object.__setattr__(self, "_other_holders", others + (holder,))
 
     def get_indentation_node(self):
         if self.on_attribute == "root":
@@ -376,16 +1896,48 @@ class Node(GenericNodesUtils):
         if isinstance(getattr(self.parent, self.on_attribute), Node):
             return self.parent.get_indentation_node()
 
+        # the indentation is given by the last endl node before me in my list
+        in_list, position = self._get_position()
+        endl_node = self._get_preceding_endl(in_list, position) if in_list is not None else None
+
         # I'm 'pass' in this kind of situation:
         # if a: pass
         # (so I don't have a previous 'endl')
-        if self.previous is None:
+        if endl_node is None:
             return self.parent.get_indentation_node()
 
-        if self.previous.type == "endl":
-            return self.previous
+        return endl_node
 
-        return self.previous.get_indentation_node()
+    def _get_preceding_endl(self, in_list, position):
+        """
+        Return the last endl node before me in in_list (or None)
+
+        The result is cached until in_list is modified, and the search
+        stops on the first previous node which has it cached, so this is
+        computed once for all the nodes of a list.
+        """
+        cache = self._indentation_cache
+        if cache is not None and cache[0] is in_list and cache[1] == in_list._list_version:
+            return cache[2]
+
+        data = in_list.data
+        endl_node = None
+        for index in range(position - 1, -1, -1):
+            node = data[index]
+            if not isinstance(node, Node):
+                continue
+
+            if node.type == "endl":
+                endl_node = node
+                break
+
+            cache = node._indentation_cache
+            if cache is not None and cache[0] is in_list and cache[1] == in_list._list_version:
+                endl_node = cache[2]
+                break
+
+        object.__setattr__(self, "_indentation_cache", (in_list, in_list._list_version, endl_node))
+        return endl_node
 
     @property
     def indentation(self):
@@ -408,7 +1960,7 @@ class Node(GenericNodesUtils):
         if self.parent is None:
             return None
 
-        if self.on_attribute is "root":
+        if self.on_attribute == "root":
             in_list = self.parent
         else:
             in_list = getattr(self.parent, self.on_attribute)
@@ -419,63 +1971,130 @@ class Node(GenericNodesUtils):
         return in_list
 
 
-    def find(self, identifier, recursive=True, **kwargs):
-        if self._node_match_query(self, identifier, **kwargs):
-            return self
+    def find_iter(self, identifier, recursive=True, limit=None, **kwargs):
+        """
+        Yield the nodes matching the query in this subtree (this node
+        included), in document order, stopping after limit nodes if limit
+        is given
+        """
+        types = get_node_types(identifier)
 
-        if not recursive:
-            return None
+        candidates = self._index_candidates(identifier, kwargs) if recursive else None
+        if candidates is None:
+            candidates = self._walk() if recursive else [self]
 
-        for kind, key, _ in filter(lambda x: x[0] == "list" or (x[0] == "key" and isinstance(getattr(self, x[1]), Node)), self._render()):
-            if kind == "key":
-                i = getattr(self, key)
-                if not i:
-                    continue
+        return itertools.islice((x for x in candidates if x.type in types and x._match(kwargs)), limit)
 
-                found = i.find(identifier, recursive, **kwargs)
-                if found:
-                    return found
+    def find(self, identifier, recursive=True, **kwargs):
+        return next(self.find_iter(identifier, recursive, limit=1, **kwargs), None)
 
-            elif kind == "list":
-                for i in getattr(self, key):
-                    found = i.find(identifier, recursive, **kwargs)
-                    if found:
-                        return found
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            # see NodeList.__getattr__
+            raise AttributeError(key)
 
-            else:
-                raise Exception()
+        if self._is_lazy(key):
+            return node_schemas[self.type].materialize(self, key)
 
-    def __getattr__(self, key):
         return self.find(key)
 
-    def find_all(self, identifier, recursive=True, **kwargs):
-        to_return = NodeList([])
-        if self._node_match_query(self, identifier, **kwargs):
-            to_return.append(self)
+    def _is_lazy(self, key):
+        "Is this attribute still only available in its raw FST form?"
+        if self._fst is None:
+            return False
 
-        if not recursive:
-            return to_return
+        if key not in self._list_keys and key not in self._dict_keys:
+            return False
 
-        for kind, key, _ in filter(lambda x: x[0] == "list" or (x[0] == "key" and isinstance(getattr(self, x[1]), Node)), self._render()):
-            if kind == "key":
-                i = getattr(self, key)
-                if not i:
-                    continue
+        try:
+            # bypass __getattr__ which would build the attribute
+            object.__getattribute__(self, key)
+        except AttributeError:
+            return True
 
-                to_return += i.find_all(identifier, recursive, **kwargs)
+        return False
 
-            elif kind == "list":
-                for i in getattr(self, key):
-                    to_return += i.find_all(identifier, recursive, **kwargs)
+    # the key lists are shared between all the nodes of the same type (and
+    # with the same kind of content for their "key" entries), see NodeSchema
+    @property
+    def _str_keys(self):
+        return self._keys[0]
 
-            else:
-                raise Exception()
+    @property
+    def _list_keys(self):
+        return self._keys[1]
 
-        return to_return
+    @property
+    def _dict_keys(self):
+        return self._keys[2]
+
+    @property
+    def _child_keys(self):
+        return self._keys[3]
+
+    def _get_children(self):
+        "Return the children of this node that queries look at, in document order"
+        children = []
+        for key in self._keys[3]:
+            value = getattr(self, key)
+            if isinstance(value, NodeList):
+                children.extend(value)
+            elif isinstance(value, Node):
+                children.append(value)
+        return children
+
+    def __getstate__(self):
+        state = {}
+        for key in self._all_slots:
+            try:
+                state[key] = object.__getattribute__(self, key)
+            except AttributeError:
+                # lazy attribute not built yet
+                pass
+        # subclasses defined outside of redbaron can have a __dict__
+        state.update(getattr(self, "__dict__", {}))
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
+
+    def find_all(self, identifier, recursive=True, **kwargs):
+        return NodeList(self.find_iter(identifier, recursive, **kwargs))
+
+    def _walk(self):
+        "Yield the nodes of this subtree in document order"
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+
+            children = node._get_children()
+            children.reverse()
+            stack.extend(children)
 
     findAll = find_all
     __call__ = find_all
 
+    def _index_candidates(self, identifier, kwargs):
+        """
+        Return the nodes of this subtree that can match the query using the
+        index of the tree (see RedBaron.enable_index), or None if there is
+        no index
+        """
+        index = self._get_index()
+        if index is None:
+            return None
+
+        return index.find_all(identifier, self, kwargs)
+
+    def _str_key_changed(self, key, old_value):
+        "Like _changed but for a string attribute, see NodeIndex.set_value"
+        for root in self._clear_caches():
+            root._version += 1
+            if root._index is not None:
+                root._index.set_value(self, key, old_value)
+
     def parent_find(self, identifier, **kwargs):
         current = self
         while current.parent and current.on_attribute != 'root':
@@ -486,33 +2105,30 @@ class Node(GenericNodesUtils):
         return None
 
     def _node_match_query(self, node, identifier, **kwargs):
-        if identifier.lower() not in node._generate_identifiers():
-            return False
-
-        all_my_keys = node._str_keys + node._list_keys + node._dict_keys
+        return node.type in get_node_types(identifier) and node._match(kwargs)
 
+    def _match(self, kwargs):
+        "Does this node have all the attributes values of kwargs?"
         for key in kwargs:
-            if key not in all_my_keys:
+            if key not in self._str_keys and key not in self._list_keys and key not in self._dict_keys:
                 return False
 
-            if getattr(node, key) != kwargs[key]:
+            if getattr(self, key) != kwargs[key]:
                 return False
 
         return True
 
     def find_by_path(self, path):
-        return Path(self, path).node()
+        return Path.from_baron_path(self, path).node
+
+    def find_by_paths(self, paths):
+        return [x.node for x in Path.from_baron_paths(self, paths)]
 
     def path(self):
         return Path(self)
 
     def _generate_identifiers(self):
-        return sorted(set(map(lambda x: x.lower(), [
-            self.type,
-            self.__class__.__name__,
-            self.__class__.__name__.replace("Node", ""),
-            self.type + "_"
-        ] + self._other_identifiers)))
+        return sorted(node_identifiers(self.__class__, self.type))
 
     def _get_helpers(self):
         not_helpers = set([
@@ -521,6 +2137,8 @@ class Node(GenericNodesUtils):
             'find',
             'findAll',
             'find_all',
+            'find_iter',
+            'select',
             'fst',
             'help',
             'next_generator',
@@ -529,25 +2147,85 @@ class Node(GenericNodesUtils):
             'indentation_node_is_direct',
             'parent_find',
             'path',
-            'find_by_path'
+            'find_by_path',
+            'find_by_paths',
+            'identity_key'
         ])
         return [x for x in dir(self) if not x.startswith("_") and x not in not_helpers and inspect.ismethod(getattr(self, x))]
 
     def fst(self):
+        # the untouched parts of a lazy node are taken from its raw FST
         to_return = {}
         for key in self._str_keys:
             to_return[key] = getattr(self, key)
         for key in self._list_keys:
-            to_return[key] = [node.fst() for node in getattr(self, key)]
+            if self._is_lazy(key):
+                to_return[key] = normalize_raw_fst(self._fst[key])
+            else:
+                to_return[key] = [node.fst() for node in getattr(self, key)]
         for key in self._dict_keys:
-            if getattr(self, key):
+            if self._is_lazy(key):
+                to_return[key] = normalize_raw_fst(self._fst[key])
+            elif getattr(self, key):
                 to_return[key] = getattr(self, key).fst()
             else:
                 to_return[key] = {}
         return to_return
 
     def dumps(self):
-        return baron.dumps(self.fst())
+        parts = []
+        self._dump(parts)
+        return "".join(parts)
+
+    def _dump(self, parts):
+        """
+        Append the source code of the node to parts
+
+        This gives the same result as baron.dumps(self.fst()) by following
+        nodes_rendering_order on the nodes themselves, without building
+        the FST of the subtree first.
+
+        The result is kept until the node or one of its descendants is
+        modified (see _clear_caches), so dumping a tree again after a
+        modification only renders the ancestors of the modified nodes
+        and reuses the source code of everything else.
+        """
+        cached = self._dump_cache
+        if cached is not None:
+            parts.append(cached)
+            return
+
+        own_parts = []
+        lazy = self._fst is not None
+        for kind, key, dependent in node_schemas[self.type].render_steps:
+            if dependent is not True and not _dependency_met(self._get_fst_value, dependent):
+                continue
+
+            if kind == "constant":
+                own_parts.append(key)
+            elif lazy and self._is_lazy(key):
+                _dump_raw_fst(self._fst[key], own_parts)
+            else:
+                value = getattr(self, key)
+                if isinstance(value, string_instance):
+                    own_parts.append(value)
+                else:
+                    value._dump(own_parts)
+
+        cached = "".join(own_parts)
+        object.__setattr__(self, "_dump_cache", cached)
+        parts.append(cached)
+
+    def _get_fst_value(self, key):
+        "Return something with the truth value of the FST value of key"
+        if key not in self._str_keys and key not in self._list_keys and key not in self._dict_keys:
+            return None
+        if self._fst is not None and self._is_lazy(key):
+            return self._fst[key]
+        value = getattr(self, key)
+        if isinstance(value, Node):
+            return True
+        return value
 
     def help(self, deep=2, with_formatting=False):
         if runned_from_ipython():
@@ -598,23 +2276,125 @@ class Node(GenericNodesUtils):
         return not self != other
 
     def __ne__(self, other):
+        if other is self:
+            return False
+
+        # nodes with the same keys but different hashes can't be equal
+        if isinstance(other, Node) and other._keys is self._keys and other._structural_hash() != self._structural_hash():
+            return True
+
         for key in itertools.chain(self._str_keys, self._list_keys, self._dict_keys):
             if getattr(self, key) != getattr(other, key, None):
                 return True
         return False
 
-    def copy(self):
-        # XXX not very optimised but at least very simple
-        return to_node(self.fst())
+    def __hash__(self):
+        """
+        Nodes that are equal have the same hash, so a node can be put in a
+        set or used as a dict key, as long as it isn't modified while it is
+        there. To key a dict by the node itself, see identity_key.
+        """
+        return self._structural_hash()
+
+    def identity_key(self):
+        """
+        Return a key that is only equal to the keys of this very node, even
+        after it has been modified, see IdentityKey
+        """
+        return IdentityKey(self)
 
-    def __setattr__(self, name, value):
-        if name == "init" or self.init:
-            return super(Node, self).__setattr__(name, value)
+    def _structural_hash(self):
+        """
+        Return a hash of the content of this subtree (the keys compared by
+        __eq__)
 
+        The hash of a node is computed from the hashes of its children and
+        kept until the node or one of its descendants is modified (see
+        _clear_caches), so after a modification only the hashes of the
+        ancestors of the modified node are computed again.
+        """
+        cached = self._hash_cache
+        if cached is not None:
+            return cached
+
+        values = [getattr(self, key) for key in self._str_keys]
+        for key in self._list_keys + self._dict_keys:
+            value = getattr(self, key)
+            values.append(value._structural_hash() if value is not None else None)
+
+        to_return = hash(tuple(values))
+        object.__setattr__(self, "_hash_cache", to_return)
+        return to_return
+
+    def copy(self, share_formatting=False):
+        """
+        Return a copy of this node without parent.
+
+        The tree is cloned directly, node by node, without going through
+        its FST. With share_formatting=True, the formatting lists (spaces,
+        comments...) are not cloned: the copy keeps them in their raw FST
+        form, like in lazy mode, and only builds them if they are accessed.
+        """
+        return self._clone(None, None, share_formatting)
+
+    def _clone(self, parent, on_attribute, share_formatting):
+        setattr_ = object.__setattr__
+        getattr_ = object.__getattribute__
+
+        clone = object.__new__(self.__class__)
+        setattr_(clone, "parent", parent)
+        setattr_(clone, "on_attribute", on_attribute)
+        setattr_(clone, "_keys", self._keys)
+        setattr_(clone, "_position", self._position)
+        setattr_(clone, "_indentation_cache", None)
+        setattr_(clone, "_path_cache", None)
+        # the clone has the same content
+        setattr_(clone, "_hash_cache", self._hash_cache)
+        setattr_(clone, "_dump_cache", self._dump_cache)
+        setattr_(clone, "_other_holders", None)
+
+        for key in self._str_keys:
+            setattr_(clone, key, getattr_(self, key))
+
+        # raw FST of the attributes that the clone doesn't build, it is
+        # never modified so it can be shared with the original, except if
+        # it comes from a file that RedBaron.close can release
+        raw = {}
+        formatting_keys = node_schemas[self.type].formatting_keys if share_formatting else ()
+
+        for key in self._list_keys + self._dict_keys:
+            if self._is_lazy(key):
+                value = self._fst[key]
+                raw[key] = copy_fst(value) if isinstance(value, (BinaryDict, BinaryList)) else value
+                continue
+
+            value = getattr_(self, key)
+            if value is None:
+                setattr_(clone, key, None)
+            elif key in formatting_keys:
+                raw[key] = value.fst()
+            else:
+                setattr_(clone, key, value._clone(clone, key, share_formatting))
+
+        setattr_(clone, "_fst", raw if raw else None)
+
+        # subclasses defined outside of redbaron can have a __dict__
+        if hasattr(self, "__dict__"):
+            clone.__dict__.update(self.__dict__)
+
+        return clone
+
+    def __setattr__(self, name, value):
         # FIXME I'm pretty sure that Bool should also be put in the isinstance for cases like with_parenthesis/as
         # also, the int stuff won't scale to all number notations
-        if name in self._str_keys and not isinstance(value, (string_instance, int)):
-            value = str(value)
+        if name in self._str_keys:
+            if not isinstance(value, (string_instance, int)):
+                value = str(value)
+
+            old_value = object.__getattribute__(self, name)
+            super(Node, self).__setattr__(name, value)
+            self._str_key_changed(name, old_value)
+            return
 
         elif name in self._dict_keys:
             value = self._convert_input_to_node_object(value, self, name)
@@ -622,17 +2402,47 @@ class Node(GenericNodesUtils):
         elif name in self._list_keys:
             value = self._convert_input_to_node_object_list(value, self, name)
 
-        return super(Node, self).__setattr__(name, value)
+        else:
+            return super(Node, self).__setattr__(name, value)
+
+        super(Node, self).__setattr__(name, value)
+        self._changed()
 
 
     def _render(self):
         return nodes_rendering_order[self.type]
 
 
+class IdentityKey(object):
+    """Wraps a node to compare and hash it by identity
+
+    Nodes are compared by their content, IdentityKey(node) can be used as a
+    dict key (or in a set) to find the node itself, even after it has been
+    modified: {node.identity_key(): "x" for node in red.find_all("def")}
+    """
+    __slots__ = ("node",)
+
+    def __init__(self, node):
+        self.node = node
+
+    def __eq__(self, other):
+        return isinstance(other, IdentityKey) and other.node is self.node
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return id(self.node)
+
+    def __repr__(self):
+        return "IdentityKey(%r)" % (self.node,)
+
+
 class IntNode(Node):
     def __init__(self, node, *args, **kwargs):
         super(IntNode, self).__init__(node, *args, **kwargs)
-        self.value = int(self.value)
+        # still part of the construction, not a modification of the tree
+        object.__setattr__(self, "value", int(self.value))
 
     def fst(self):
         return {
@@ -641,14 +2451,17 @@ class IntNode(Node):
             "section": "number",
         }
 
+    def _dump(self, parts):
+        parts.append(str(self.value))
+
 
 class EndlNode(Node):
     def __repr__(self):
-        return repr(baron.dumps([self.fst()]))
+        return repr(self.dumps())
 
 class SpaceNode(Node):
     def __repr__(self):
-        return repr(baron.dumps([self.fst()]))
+        return repr(self.dumps())
 
 
 class ImportNode(Node):
@@ -782,21 +2595,522 @@ class CallNode(Node):
         self.value.append_comma(value, parent=self, on_attribute="value", trailing=trailing)
 
 
+def get_baron_version():
+    try:
+        return baron.__version__
+    except AttributeError:
+        pass
+
+    try:
+        from importlib.metadata import version
+        return version("baron")
+    except Exception:
+        pass
+
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution("baron").version
+    except Exception:
+        return "unknown"
+
+
+class ParseCache(object):
+    """On disk cache of the FST produced by baron.parse
+
+    The FST of a source code is stored in the given directory, in a file
+    named after a hash of the source code and of the versions of baron
+    and python, and reused instead of parsing the same source code again.
+
+    When the size of the directory grows over max_size bytes, the least
+    recently used entries are removed until it is back under a fraction
+    (EVICT_TO) of max_size, so a full cache isn't evicted on every write.
+    The size is computed once, on the first write, then kept up to date
+    by this instance: the directory is only scanned again when it goes
+    over max_size (entries written by other processes are only seen
+    then).
+    """
+    EVICT_TO = 0.9
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.baron_version = get_baron_version()
+        # size of the directory, None until the first write, see _grown
+        self._size = None
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, source_code):
+        if not isinstance(source_code, bytes):
+            source_code = source_code.encode("Utf-8")
+
+        hash_ = hashlib.sha1()
+        hash_.update(("%s-%s-" % (self.baron_version, sys.version_info[:2])).encode("Utf-8"))
+        hash_.update(source_code)
+        return hash_.hexdigest()
+
+    def path(self, source_code):
+        return os.path.join(self.directory, self.key(source_code) + ".fst")
+
+    def get(self, source_code):
+        "Return the cached FST of this source code or None"
+        path = self.path(source_code)
+        try:
+            with open(path, "rb") as cache_file:
+                fst = pickle.load(cache_file)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # corrupted entry, consider it as missing
+            size = self._get_size(path)
+            self._remove(path)
+            if self._size is not None:
+                self._size -= size
+            return None
+
+        # used for the least recently used eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return fst
+
+    def set(self, source_code, fst):
+        path = self.path(source_code)
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as cache_file:
+                pickle.dump(fst, cache_file, pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(temporary_path)
+            old_size = self._get_size(path)
+            # atomic, concurrent processes never read a partial entry
+            getattr(os, "replace", os.rename)(temporary_path, path)
+        except Exception:
+            self._remove(temporary_path)
+            raise
+
+        self._grown(size - old_size)
+
+    def parse(self, source_code):
+        "Like baron.parse but use the cache"
+        fst = self.get(source_code)
+        if fst is None:
+            fst = baron.parse(source_code)
+            self.set(source_code, fst)
+        return fst
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _grown(self, delta):
+        "Update the size of the cache after a write and evict entries if needed"
+        if self._size is None:
+            # the new entry is already in the directory
+            self._size = self.size()
+        else:
+            self._size += delta
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        "Remove the least recently used entries if the cache doesn't fit in max_size"
+        entries = sorted(self._entries(), key=lambda x: x[2])
+        size = sum(x[1] for x in entries)
+        if size > self.max_size:
+            while entries and size > self.max_size * self.EVICT_TO:
+                path, entry_size, _ = entries.pop(0)
+                self._remove(path)
+                size -= entry_size
+        self._size = size
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            self._remove(path)
+        self._size = 0
+
+    def _entries(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith(".fst"):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed by a concurrent process
+                continue
+
+            yield (path, stat.st_size, stat.st_mtime)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _get_size(self, path):
+        "Return the size of a file, 0 if it doesn't exist"
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+
+# set it to a ParseCache instance to use it by default in RedBaron
+parse_cache = None
+
+
+# those keywords continue the previous statement
+CONTINUATION_KEYWORDS = ("else", "elif", "except", "finally")
+
+
+def split_top_level_statements(source):
+    """
+    Yield the source code (a string or a file object) in chunks that
+    each contain one top level statement (with the comments and empty
+    lines that follow it), reading it line by line.
+    """
+    if isinstance(source, string_instance):
+        readline = functools.partial(next, iter(source.splitlines(True)), "")
+    else:
+        readline = source.readline
+
+    # lines read by the tokenizer that haven't been yielded yet
+    lines = []
+    first_line_number = 1
+
+    def read_line():
+        line = readline()
+        if line:
+            lines.append(line)
+        return line
+
+    new_logical_line = True
+    after_decorator = False
+    try:
+        for token_type, string, (line_number, column), _, _ in tokenize.generate_tokens(read_line):
+            if token_type in (tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER):
+                continue
+
+            if token_type == tokenize.NEWLINE:
+                new_logical_line = True
+                continue
+
+            if not new_logical_line:
+                continue
+
+            new_logical_line = False
+            if column == 0 and line_number > first_line_number and not after_decorator and string not in CONTINUATION_KEYWORDS:
+                yield "".join(lines[:line_number - first_line_number])
+                del lines[:line_number - first_line_number]
+                first_line_number = line_number
+
+            after_decorator = string == "@"
+
+    except (tokenize.TokenError, SyntaxError):
+        # let baron complain about the invalid source code
+        while read_line():
+            pass
+
+    if lines:
+        yield "".join(lines)
+
+
+def _parse_path(path, cache=None):
+    "Used by RedBaron.from_paths in the worker processes"
+    with open(path, "r") as source_file:
+        source_code = source_file.read()
+
+    fst = cache.parse(source_code) if cache is not None else baron.parse(source_code)
+
+    # marshal is way faster than pickle to send the FST back to the parent
+    return path, marshal.dumps(fst)
+
+
+# the ParseCache of a worker process of RedBaron.from_paths
+_worker_cache = None
+
+
+def _init_worker(cache):
+    """
+    Initializer of the worker processes of RedBaron.from_paths: the cache
+    is only sent once to each worker, which keeps it (and the size of the
+    cache directory that it tracks) for all the files it parses
+    """
+    global _worker_cache
+    _worker_cache = cache
+
+
+def _parse_path_in_worker(path):
+    return _parse_path(path, _worker_cache)
+
+
 class RedBaron(NodeList):
-    def __init__(self, source_code):
+    _lazy = False
+    # incremented on every modification of the tree, see _changed
+    _version = 0
+    _index = None
+    # memory mapped file of a tree loaded with RedBaron.load, see close
+    _buffer = None
+
+    def __init__(self, source_code, lazy=False, cache=None):
+        """
+        If lazy is True, the nodes are only built on first access, the
+        untouched parts of the tree are kept in their raw FST form.
+
+        cache is a ParseCache used to avoid parsing again source code that
+        has already been parsed (redbaron.parse_cache by default).
+        """
         if isinstance(source_code, string_instance):
-            self.data = [to_node(x, parent=self, on_attribute="root") for x in baron.parse(source_code)]
+            cache = cache if cache is not None else parse_cache
+            fst = cache.parse(source_code) if cache is not None else baron.parse(source_code)
+            self._lazy = lazy
+            self.data = self._build_nodes(fst)
         else:
             # Might be init from same object, or slice
             NodeList.__init__(self, source_code)
 
+    def _build_nodes(self, fst):
+        return [to_node(x, parent=self, on_attribute="root", lazy=self._lazy) for x in fst]
+
+    @classmethod
+    def from_fst(class_, fst, lazy=False):
+        red = class_([])
+        red._lazy = lazy
+        red.data = red._build_nodes(fst)
+        return red
+
+    @classmethod
+    def from_paths(class_, paths, workers=None, lazy=False, cache=None):
+        """
+        Parse the given files in a pool of worker processes and yield
+        (path, RedBaron instance) tuples as soon as they are ready (so not
+        necessary in the same order than paths).
+
+        workers is the number of processes (the number of CPUs by
+        default), with 1 the files are parsed in the current process.
+        """
+        cache = cache if cache is not None else parse_cache
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        if workers <= 1:
+            for path in paths:
+                path, fst = _parse_path(path, cache)
+                yield path, class_.from_fst(marshal.loads(fst), lazy=lazy)
+            return
+
+        pool = multiprocessing.Pool(workers, _init_worker, (cache,))
+        try:
+            for path, fst in pool.imap_unordered(_parse_path_in_worker, paths):
+                yield path, class_.from_fst(marshal.loads(fst), lazy=lazy)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @classmethod
+    def iter_statements(class_, source, lazy=False, cache=None):
+        """
+        Yield the top level nodes of the source code (a string or a file
+        object) one by one without building the whole tree: the source
+        code is split on the top level statements which are parsed one at
+        a time. The parent of the yielded nodes is a RedBaron instance
+        only containing the nodes of the same statement.
+        """
+        for statement in split_top_level_statements(source):
+            for node in class_(statement, lazy=lazy, cache=cache):
+                yield node
+
+    def enable_index(self):
+        """
+        Index the nodes of the tree by type: find and find_all (on any node
+        of the tree) then only look at the nodes of the requested type
+        instead of walking the whole subtree. The index is kept in sync
+        with the modifications of the tree.
+        """
+        if self._index is None:
+            self._index = NodeIndex(self)
+
+    def disable_index(self):
+        self._index = None
+
+    def find_iter(self, identifier, recursive=True, limit=None, **kwargs):
+        if recursive and self._index is not None:
+            return itertools.islice((x for x in self._index.find_all(identifier, kwargs=kwargs) if x._match(kwargs)), limit)
+
+        return super(RedBaron, self).find_iter(identifier, recursive, limit, **kwargs)
+
+    def save(self, path):
+        "Save the tree in a compact binary format, see RedBaron.load"
+        with open(path, "wb") as binary_file:
+            binary_file.write(fst_to_binary(self.fst()))
+
+    @classmethod
+    def load(class_, path):
+        """
+        Load a tree saved with RedBaron.save. The file is memory mapped and
+        the tree is lazy (see RedBaron.__init__): only the nodes that are
+        accessed are decoded and built.
+        """
+        with open(path, "rb") as binary_file:
+            buffer = mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        red = class_.from_fst(binary_to_fst(buffer), lazy=True)
+        red._buffer = buffer
+        return red
+
+    def close(self):
+        """
+        Release the memory mapped file of a tree loaded with RedBaron.load,
+        the parts of the tree that haven't been built yet are decoded
+        first so the tree stays usable
+        """
+        if self._buffer is None:
+            return
+
+        stack = list(self.data)
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, Node):
+                continue
+
+            if node._fst is not None:
+                object.__setattr__(node, "_fst", copy_fst(node._fst))
+
+            for key in node._list_keys + node._dict_keys:
+                if node._is_lazy(key):
+                    continue
+                value = getattr(node, key)
+                if isinstance(value, NodeList):
+                    stack.extend(value.data)
+                elif isinstance(value, Node):
+                    stack.append(value)
+
+        self._buffer.close()
+        self._buffer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # a mmap can't be pickled, the tree is decoded instead, see
+        # BinaryDict.__reduce__
+        state.pop("_buffer", None)
+        return state
+
+    def apply_edit(self, start, end, text):
+        """
+        Replace the source code between the start and end positions by
+        text, positions are (line, column) tuples starting at 1 like in
+        baron, end is excluded.
+
+        Only the top level statements touched by the edit (and their
+        direct neighbours) are parsed again and replaced, the other nodes
+        are kept untouched. If this region can't be parsed on its own, the
+        whole source code is parsed again.
+
+        Return the node list of the new top level nodes.
+        """
+        texts = [x.dumps() for x in self.data]
+        offsets = [0]
+        for node_text in texts:
+            offsets.append(offsets[-1] + len(node_text))
+
+        source_code = "".join(texts)
+        start_offset = self._position_to_offset(source_code, start)
+        end_offset = self._position_to_offset(source_code, end)
+        if end_offset < start_offset:
+            raise ValueError("end %s is before start %s" % (end, start))
+
+        new_source_code = source_code[:start_offset] + text + source_code[end_offset:]
+
+        # split the top level nodes in groups that each start with a
+        # statement at the beginning of a line: the source code can
+        # safely be parsed again from one of those boundaries to another
+        boundaries = [0] + [position for position in range(1, len(self.data)) if self._is_statement_start(position, texts, source_code, offsets)]
+        group_offsets = [offsets[x] for x in boundaries]
+        boundaries.append(len(self.data))
+
+        first_group = bisect.bisect_right(group_offsets, start_offset) - 1
+        last_group = bisect.bisect_right(group_offsets, max(start_offset, end_offset - 1)) - 1
+
+        # also take the neighbours, the edit can change how they are parsed
+        # (for example by adding an 'else' clause to the previous statement)
+        first_group = max(first_group - 1, 0)
+        last_group = min(last_group + 1, len(group_offsets) - 1)
+
+        region_start, region_end = boundaries[first_group], boundaries[last_group + 1]
+        region = source_code[offsets[region_start]:start_offset] + text + source_code[end_offset:offsets[region_end]]
+
+        try:
+            fst = baron.parse(region)
+        except Exception:
+            fst = None
+
+        if fst is None or baron.dumps(fst) != region:
+            # will raise if the new source code is invalid, in this case
+            # the tree stays untouched
+            fst = baron.parse(new_source_code)
+            if fst is None:
+                # baron sometimes only prints its errors
+                raise Exception("Baron has failed to parse the new source code")
+            region_start, region_end = 0, len(self.data)
+
+        new_nodes = self._build_nodes(fst)
+        self.data[region_start:region_end] = new_nodes
+        self._positions_cache = None
+        self._changed()
+        return NodeList(new_nodes)
+
+    def _is_statement_start(self, position, texts, source_code, offsets):
+        if self.data[position].type in ("endl", "comment"):
+            return False
+
+        if source_code[offsets[position] - 1] != "\n":
+            return False
+
+        return texts[position][:1] not in ("", " ", "\t", "#")
+
+    def _position_to_offset(self, source_code, position):
+        line, column = position
+        offset = 0
+        for _ in range(line - 1):
+            offset = source_code.find("\n", offset) + 1
+            if offset == 0:
+                raise ValueError("line %s is after the end of the source code" % line)
+
+        line_end = source_code.find("\n", offset)
+        line_end = len(source_code) if line_end == -1 else line_end
+        if column < 1 or offset + column - 1 > line_end:
+            raise ValueError("column %s is outside of line %s" % (column, line))
+
+        return offset + column - 1
+
 
 # to avoid to have to declare EVERY node class, dynamically create the missings
 # ones using nodes_rendering_order as a reference
+# node_classes maps every baron type to its (unique) class, this is what
+# to_node uses to instanciate nodes
+node_classes = {}
+node_schemas = {}
+# reverse of node_identifiers: identifier -> types of the nodes it matches
+node_types_by_identifier = {}
 for node_type in nodes_rendering_order:
-    class_name = node_type.capitalize() + "Node"
+    node_schemas[node_type] = NodeSchema(node_type)
+    class_name = node_class_name(node_type)
     if class_name not in globals():
         globals()[class_name] = type(class_name, (Node,), {})
+    node_classes[node_type] = globals()[class_name]
+    for identifier in node_identifiers(node_classes[node_type], node_type):
+        node_types_by_identifier.setdefault(identifier, set()).add(node_type)
+
+node_types_by_identifier = dict((x, frozenset(y)) for x, y in node_types_by_identifier.items())
 
 
 ipython_behavior = True
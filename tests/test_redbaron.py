@@ -2,11 +2,18 @@
 # -*- coding:Utf-8 -*-
 
 
+import os
+import pickle
+
 import baron
 import pytest
 from baron.path import make_path, path_to_node
+from baron.render import nodes_rendering_order
 from redbaron import (RedBaron, NameNode, EndlNode, IntNode, AssignmentNode,
-                      PassNode, NodeList, CommaNode, DotNode, CallNode)
+                      PassNode, NodeList, CommaNode, DotNode, CallNode,
+                      node_classes, ParseCache, split_top_level_statements,
+                      fst_to_binary, binary_to_fst, copy_fst, get_node_types,
+                      Selector, Visitor, Path, IdentityKey)
 
 
 def test_empty():
@@ -31,6 +38,17 @@ def test_int():
     assert red[0].value == 1
 
 
+def test_int_construction_is_not_a_modification():
+    red = RedBaron("a = 1\nb = 2\n")
+    assert red._version == 0
+    red = RedBaron("a = 1\nb = 2\n", lazy=True)
+    red.dumps()
+    version, dump_cache = red._version, red[2]._dump_cache
+    assert red[2].value.value == 2
+    assert red._version == version
+    assert red[2]._dump_cache is dump_cache
+
+
 def test_assign():
     red = RedBaron("a = 2")
     assert isinstance(red[0], AssignmentNode)
@@ -74,6 +92,74 @@ def test_dumps():
     assert some_code == red.dumps()
 
 
+DUMPS_SOURCE = """\
+@deco(1)
+def a(b, c=1, *args, **kwargs):
+    \"\"\"doc\"\"\"
+    try:
+        return b[1:2] + c  # comment
+    except (A, B) as e:
+        print "plop", -b
+    finally:
+        yield
+    with x as y, z: pass
+    return lambda x=3: {1: [i for i in b if i], 2: (3,)}
+"""
+
+
+def test_dumps_is_baron_dumps():
+    red = RedBaron(DUMPS_SOURCE)
+    assert red.dumps() == DUMPS_SOURCE
+    for node in [x.node for x in Path.from_subtree(red)]:
+        assert node.dumps() == baron.dumps(node.fst())
+        for key in node._list_keys:
+            assert getattr(node, key).dumps() == baron.dumps(getattr(node, key).fst())
+
+
+def test_dumps_after_modification():
+    red = RedBaron("a = 1\n")
+    red[0].value.value = 42
+    red[0].target = "b.c"
+    assert red.dumps() == "b.c = 42\n"
+
+
+def test_dumps_cache_invalidation():
+    red = RedBaron("def a(x):\n    return x + 1\n\ndef b(y):\n    pass\n")
+    assert red.dumps() == "def a(x):\n    return x + 1\n\ndef b(y):\n    pass\n"
+    assert red[1]._dump_cache is not None
+    red[0].arguments[0].name = "z"
+    assert red[0]._dump_cache is None
+    assert red[0].value[1]._dump_cache is not None
+    assert red[1]._dump_cache is not None
+    assert red.dumps() == "def a(z):\n    return x + 1\n\ndef b(y):\n    pass\n"
+    red[0].value[1].value.second = "2"
+    assert red.dumps() == "def a(z):\n    return x + 2\n\ndef b(y):\n    pass\n"
+    red[1].value.append(red.find("return").copy())
+    assert red.dumps() == baron.dumps(red.fst())
+    assert red.dumps().endswith("pass\nreturn x + 2")
+    red[1].value.pop()
+    red[1].name = "c"
+    assert red.dumps() == baron.dumps(red.fst())
+    assert red[1].copy().dumps() == red[1].dumps()
+
+
+def test_caches_of_a_node_held_twice():
+    red = RedBaron("a = b\nc = d\n")
+    red[0].value = red[2].value
+    assert red.dumps() == "a = d\nc = d\n"
+    structural_hash = hash(red[2])
+    red[0].value.value = "e"
+    assert red.dumps() == "a = e\nc = e\n"
+    assert hash(red[2]) != structural_hash
+
+    red = RedBaron("def f():\n    pass\n\nx = 1\n")
+    assignment = red[-2]
+    red[0].value.append(assignment)
+    red.dumps()
+    assignment.value.value = 5
+    assert red.dumps() == baron.dumps(red.fst())
+
+
 def test_fst():
     some_code = "ax + (z * 4)"
     red = RedBaron(some_code)
@@ -130,6 +216,13 @@ def test_generate_helpers():
     assert set(red[0]._generate_identifiers()) == set(["funcdef", "funcdef_", "funcdefnode", "def", "def_"])
 
 
+def test_get_node_types():
+    assert get_node_types("def") == frozenset(["funcdef"])
+    assert get_node_types("FuncDefNode") == frozenset(["funcdef"])
+    assert get_node_types("name_") == frozenset(["name"])
+    assert get_node_types("pouet") == frozenset()
+
+
 def test_assign_node_list():
     red = RedBaron("[1, 2, 3]")
     l = red[0]
@@ -264,6 +357,81 @@ def test_node_previous_generator():
     assert list(red[0].value[2].previous_generator()) == list(reversed(red[0].value[:2]))
 
 
+def test_node_next_previous_after_modifications():
+    red = RedBaron("a\nb\nc\n")
+    a, b, c = red.find_all("name")
+    assert b.next.next is c
+    red.insert(0, RedBaron("d\n")[0])
+    assert b.next.next is c
+    assert a.previous.value == "d"
+    del red[1:3]
+    assert b.previous.value == "d"
+    red.data.reverse()
+    assert c.next.next is b
+    assert [x.value for x in b.previous_generator() if x.type == "name"] == ["c"]
+
+
+def test_append_endl_without_statement():
+    red = RedBaron("def f():\n    pass\n")
+    endls = NodeList([x for x in red[0].value.data if x.type == "endl"])
+    with pytest.raises(IndexError):
+        endls.append_endl("a", parent=red[0], on_attribute="value")
+
+
+def test_positions_are_kept_up_to_date():
+    red = RedBaron("a\nb\nc\n")
+    assert red.index(red[4]) == 4
+    positions = red._positions_cache
+    nodes = list(red)
+    for node in nodes:
+        object.__setattr__(node, "_position", None)
+
+    red.insert(1, RedBaron("d\n")[0])
+    red.append(RedBaron("e\n")[0])
+    red[0] = RedBaron("f\n")[0]
+    del red[2]
+    red.pop(-2)
+    red.remove(red[3])
+    red.extend([RedBaron("g\n")[0]])
+    assert red._positions_cache is positions
+    assert [red._index_of(x) for x in red] == list(range(len(red)))
+    assert all(x._position == position for position, x in enumerate(red) if x.parent is red)
+    assert red._index_of(nodes[0]) is None
+    assert red.dumps() == "fdbceg"
+
+
+def test_node_next_same_siblings():
+    red = RedBaron("a\na\na\n")
+    assert red[2].next is red[3]
+    assert red[4].previous is red[3]
+    assert list(red[2].next_generator()) == red[3:]
+
+
+def test_node_list_identity():
+    red = RedBaron("a\na\na\n")
+    assert red[0] == red[2]
+    assert red.index(red[2]) == 2
+    assert red.index(red[4], 3) == 4
+    with pytest.raises(ValueError):
+        red.index(red[2], 3)
+    assert red.count(red[2]) == 1
+    other = RedBaron("a\n")[0]
+    assert other not in red
+    assert red[4] in red
+    with pytest.raises(ValueError):
+        red.remove(other)
+    a = red[2]
+    red.remove(a)
+    assert a not in red
+    assert [x.type for x in red] == ["name", "endl", "endl", "name", "endl"]
+    assert red.map(lambda x: x.type).index("endl") == 1
+
+
+def test_path_same_siblings():
+    red = RedBaron("a\na\na\n")
+    assert [x.path().to_baron_path().position_in_rendering_list for x in red] == [0, 1, 2, 3, 4, 5]
+
+
 def test_map():
     red = RedBaron("[1, 2, 3]")
     assert red('int').map(lambda x: x.value) == NodeList([1, 2, 3])
@@ -483,6 +651,25 @@ def test_indentation_endl():
     assert not red[0].value[-2].indentation_node_is_direct()
 
 
+def test_indentation_after_modifications():
+    red = RedBaron("def a():\n    b = 1\n    c = 2\n")
+    body = red[0].value
+    assert body[3].indentation == "    "
+    body[2].indent = "  "
+    assert body[3].indentation == "  "
+    body.insert(3, RedBaron("def z():\n        pass\n")[0].value[0])
+    assert body[4].indentation == "        "
+    del body[2:4]
+    assert body[2].indentation == "    "
+
+
+def test_indentation_one_line_while_append():
+    red = RedBaron("while a: pass\n")
+    red[0].append_value("b")
+    assert red.dumps() == "while a:\n    pass\n    b\n"
+    assert red[0].value[-2].indentation == "    "
+
+
 def test_filtered_endl():
     red = RedBaron("while a:\n    pass\n")
     assert red[0].value.filtered() == (red[0].value[-2],)
@@ -930,6 +1117,703 @@ def test_copy_correct_isntance():
     assert isinstance(red[0].value[1].copy(), CallNode)
 
 
+def test_node_class_is_shared_between_instances():
+    red = RedBaron("import a.b as c, d.e as f")
+    first, second = red("dotted_as_name")
+    assert first.__class__ is second.__class__
+    assert first.__class__ is node_classes["dotted_as_name"]
+    assert first.__class__.__name__ == "DottedAsNameNode"
+
+
+def test_node_classes_cover_every_baron_type():
+    assert set(node_classes) == set(nodes_rendering_order)
+    assert node_classes["int"] is IntNode
+
+
+def test_keys_are_shared_between_nodes_of_the_same_type():
+    red = RedBaron("a = 1\nb = 2\n")
+    first, second = red("assignment")
+    assert first._str_keys is second._str_keys
+    assert first._list_keys is second._list_keys
+    assert first._dict_keys is second._dict_keys
+    assert first._str_keys == ("type",)
+    assert first._dict_keys == ("target", "operator", "value")
+
+
+def test_keys_depends_on_the_content_of_the_node():
+    red = RedBaron("a = 1\nb += 2\n")
+    assert "operator" in red[0]._dict_keys
+    assert "operator" in red[2]._str_keys
+    assert red[2].operator == "+"
+
+
+def test_nodes_have_slots():
+    red = RedBaron("a = 1")
+    assert not hasattr(red[0], "__dict__")
+    assert "target" in type(red[0]).__slots__
+    assert "value" in IntNode.__slots__
+    with pytest.raises(AttributeError):
+        red[0].not_a_key = 42
+
+
+def test_pickle_lazy():
+    red = RedBaron("def a():\n    pass\n", lazy=True)
+    unpickled = pickle.loads(pickle.dumps(red))
+    assert unpickled.dumps() == red.dumps()
+    assert unpickled[0]._is_lazy("value")
+
+
+def test_pickle():
+    red = RedBaron("import a.b as c\n")
+    unpickled = pickle.loads(pickle.dumps(red))
+    assert unpickled.dumps() == red.dumps()
+    assert unpickled[0].value[0].parent is unpickled[0]
+
+
+def test_lazy_dumps():
+    some_code = "def a(b, c=1):\n    return b + c\n"
+    red = RedBaron(some_code, lazy=True)
+    assert red.dumps() == some_code
+    assert red.fst() == RedBaron(some_code).fst()
+
+
+def test_lazy_fst_is_the_eager_fst():
+    some_code = "@d\ndef a(b=1.5):\n    print >>x, 3\n    return b + 0x1\n"
+    assert RedBaron(some_code, lazy=True).fst() == RedBaron(some_code).fst()
+    assert RedBaron(DUMPS_SOURCE, lazy=True).fst() == RedBaron(DUMPS_SOURCE).fst()
+    red = RedBaron(some_code, lazy=True)
+    red[0].value
+    assert red.fst() == RedBaron(some_code).fst()
+
+
+def test_lazy_dumps_of_partially_built_tree():
+    red = RedBaron(DUMPS_SOURCE, lazy=True)
+    red[0].value[3].value[1].value.first = "d"
+    assert red.dumps() == DUMPS_SOURCE.replace("return b[1:2]", "return d")
+    assert red[0]._is_lazy("arguments")
+    assert red[0].value.dumps() == baron.dumps(red[0].value.fst())
+
+
+def test_lazy_only_build_what_is_accessed():
+    red = RedBaron("def a(b):\n    return b\n", lazy=True)
+    funcdef = red[0]
+    assert funcdef.name == "a"
+    assert funcdef._is_lazy("value")
+    assert funcdef._is_lazy("arguments")
+    assert isinstance(funcdef.value, NodeList)
+    assert not funcdef._is_lazy("value")
+    assert funcdef._is_lazy("arguments")
+    assert funcdef.value[1].parent is funcdef
+    assert funcdef.value[1].on_attribute == "value"
+
+
+def test_lazy_fst_is_a_copy():
+    red = RedBaron("a = 1\n", lazy=True)
+    fst = red.fst()
+    fst[0]["value"]["value"] = "2"
+    assert red.dumps() == "a = 1\n"
+
+
+def test_lazy_modification():
+    red = RedBaron("a = b + c\n", lazy=True)
+    red[0].value.first = "plop"
+    assert red.dumps() == "a = plop + c\n"
+    assert red.find("name", value="c") is red[0].value.second
+
+
+def test_parse_cache(tmpdir, monkeypatch):
+    cache = ParseCache(str(tmpdir))
+    some_code = "a = 1 + b\n"
+    assert cache.get(some_code) is None
+    expected_fst = RedBaron(some_code, cache=cache).fst()
+    assert cache.get(some_code) == baron.parse(some_code)
+
+    def parse(source_code):
+        raise AssertionError("should have used the cache")
+
+    monkeypatch.setattr(baron, "parse", parse)
+    red = RedBaron(some_code, cache=cache)
+    assert red.dumps() == some_code
+    assert red.fst() == expected_fst
+
+
+def test_parse_cache_corrupted_entry(tmpdir):
+    cache = ParseCache(str(tmpdir))
+    with open(cache.path("a"), "w") as cache_file:
+        cache_file.write("not a pickle")
+    assert cache.get("a") is None
+    assert cache.parse("a") == baron.parse("a")
+    assert cache.get("a") == baron.parse("a")
+
+
+def test_parse_cache_eviction(tmpdir):
+    cache = ParseCache(str(tmpdir))
+    cache.parse("a")
+    cache.parse("b")
+    # room for "a" and "b" but not for a third entry of the same size
+    cache.max_size = cache.size() * 5 // 4
+    # "b" has been used more recently than "a"
+    os.utime(cache.path("a"), (1000, 1000))
+    os.utime(cache.path("b"), (2000, 2000))
+    cache.parse("c")
+    assert cache.size() <= cache.max_size
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    assert cache.get("c") is not None
+
+
+def test_parse_cache_size_is_only_scanned_once(tmpdir, monkeypatch):
+    cache = ParseCache(str(tmpdir))
+    scans = []
+    entries = cache._entries
+    monkeypatch.setattr(cache, "_entries", lambda: scans.append(1) or entries())
+    for name in ("a", "b", "c", "d"):
+        cache.parse(name)
+    assert len(scans) == 1
+    assert cache._size == cache.size()
+
+    del scans[:]
+    cache.max_size = cache._size
+    os.utime(cache.path("a"), (1000, 1000))
+    cache.parse("e")
+    assert len(scans) == 1
+    assert cache._size == cache.size() <= cache.max_size * ParseCache.EVICT_TO
+    assert cache.get("a") is None
+    assert cache.get("e") is not None
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_from_paths(tmpdir, workers):
+    sources = {}
+    for number in range(5):
+        path = tmpdir.join("module%s.py" % number)
+        sources[str(path)] = "def f%s(a):\n    return a + %s\n" % (number, number)
+        path.write(sources[str(path)])
+
+    result = dict(RedBaron.from_paths(sorted(sources), workers=workers))
+    assert sorted(result) == sorted(sources)
+    for path, red in result.items():
+        assert isinstance(red, RedBaron)
+        assert red.dumps() == sources[path]
+        assert red[0].parent is red
+        assert red[0].on_attribute == "root"
+
+
+class ScanCountingCache(ParseCache):
+    "A ParseCache writing a line in scans_log each time it scans its directory"
+    def __init__(self, directory, scans_log):
+        super(ScanCountingCache, self).__init__(directory)
+        self.scans_log = scans_log
+
+    def _entries(self):
+        with open(self.scans_log, "a") as scans_log:
+            scans_log.write("scan\n")
+        return super(ScanCountingCache, self)._entries()
+
+
+def test_from_paths_cache(tmpdir):
+    sources = {}
+    for number in range(6):
+        path = tmpdir.join("module%s.py" % number)
+        sources[str(path)] = "a = %s\n" % number
+        path.write(sources[str(path)])
+
+    scans_log = str(tmpdir.join("scans.log"))
+    cache = ScanCountingCache(str(tmpdir.join("cache")), scans_log)
+    result = dict(RedBaron.from_paths(sorted(sources), workers=2, cache=cache))
+    assert dict((x, y.dumps()) for x, y in result.items()) == sources
+    assert all(cache.get(x) is not None for x in sources.values())
+    # the size of the cache is computed once per worker, not once per file
+    with open(scans_log) as scans:
+        assert len(scans.readlines()) <= 2
+
+
+def test_from_paths_error(tmpdir):
+    path = tmpdir.join("broken.py")
+    path.write("def (:\n")
+    with pytest.raises(Exception):
+        list(RedBaron.from_paths([str(path)], workers=2))
+
+
+EDIT_SOURCE = """\
+import os
+
+def a():
+    return 1
+
+def b():
+    return 2
+
+def c():
+    return 3
+
+def d():
+    return 4
+"""
+
+
+def test_apply_edit():
+    red = RedBaron(EDIT_SOURCE)
+    import_, last = red.import_, red.find("def", name="d")
+    new_nodes = red.apply_edit((7, 12), (7, 13), "42")
+    new_source = EDIT_SOURCE.replace("return 2", "return 42")
+    assert red.dumps() == new_source
+    assert red.fst() == RedBaron(new_source).fst()
+    assert red.find("def", name="b").value.find("int").value == 42
+    assert red.find("def", name="b") in new_nodes
+    # untouched nodes are kept
+    assert red.import_ is import_
+    assert red.find("def", name="d") is last
+    assert red.find("def", name="b").parent is red
+    assert red.find("def", name="b").on_attribute == "root"
+
+
+def test_apply_edit_insert():
+    red = RedBaron(EDIT_SOURCE)
+    red.apply_edit((5, 1), (5, 1), "x = 1\n")
+    new_source = EDIT_SOURCE.replace("return 1\n", "return 1\nx = 1\n")
+    assert red.dumps() == new_source
+    assert red.fst() == RedBaron(new_source).fst()
+
+
+def test_apply_edit_change_previous_statement():
+    red = RedBaron("if a:\n    pass\n\nb = 1\n")
+    red.apply_edit((3, 1), (3, 1), "else:\n    pass\n")
+    assert red.dumps() == "if a:\n    pass\nelse:\n    pass\n\nb = 1\n"
+    assert red.fst() == RedBaron(red.dumps()).fst()
+    assert red[0].type == "ifelseblock"
+    assert len(red[0].value) == 2
+
+
+def test_apply_edit_invalid():
+    red = RedBaron(EDIT_SOURCE)
+    with pytest.raises(Exception):
+        red.apply_edit((3, 1), (3, 4), "def (")
+    assert red.dumps() == EDIT_SOURCE
+
+
+def test_apply_edit_bad_position():
+    red = RedBaron(EDIT_SOURCE)
+    with pytest.raises(ValueError):
+        red.apply_edit((42, 1), (42, 1), "")
+    with pytest.raises(ValueError):
+        red.apply_edit((1, 100), (1, 100), "")
+
+
+STATEMENTS_SOURCE = """\
+import os
+# comment
+
+@deco
+def a(b):
+    return (b +
+1)
+
+if a:
+    pass
+else:
+    pass
+x = '''
+a
+'''
+"""
+
+
+def test_split_top_level_statements():
+    assert list(split_top_level_statements(STATEMENTS_SOURCE)) == [
+        "import os\n# comment\n\n",
+        "@deco\ndef a(b):\n    return (b +\n1)\n\n",
+        "if a:\n    pass\nelse:\n    pass\n",
+        "x = '''\na\n'''\n",
+    ]
+
+
+def test_iter_statements():
+    nodes = list(RedBaron.iter_statements(STATEMENTS_SOURCE))
+    assert "".join(x.dumps() for x in nodes) == STATEMENTS_SOURCE
+    assert [x.fst() for x in nodes] == RedBaron(STATEMENTS_SOURCE).fst()
+    assert [x.type for x in nodes if x.type != "endl"] == ["import", "comment", "funcdef", "ifelseblock", "assignment"]
+    for node in nodes:
+        assert isinstance(node.parent, RedBaron)
+        assert node.on_attribute == "root"
+        assert node.parent.index(node) is not None
+
+
+def test_iter_statements_file(tmpdir):
+    path = tmpdir.join("module.py")
+    path.write(STATEMENTS_SOURCE)
+    with open(str(path)) as source_file:
+        nodes = list(RedBaron.iter_statements(source_file))
+    assert "".join(x.dumps() for x in nodes) == STATEMENTS_SOURCE
+
+
+def test_binary_fst():
+    fst = RedBaron("def a(b, c=1):\n    return b + c  # comment\n").fst()
+    binary = fst_to_binary(fst)
+    assert copy_fst(binary_to_fst(binary)) == fst
+    assert copy_fst(binary_to_fst(fst_to_binary([1, -2, True, False, None, {}, []]))) == [1, -2, True, False, None, {}, []]
+
+
+def test_binary_fst_strings_are_only_stored_once():
+    assert fst_to_binary(RedBaron("aaaaaaaaaa\n" * 100).fst()).count(b"aaaaaaaaaa") == 1
+
+
+def test_binary_fst_not_a_binary_fst():
+    with pytest.raises(ValueError):
+        binary_to_fst(b"pouet")
+
+
+def test_save_and_load(tmpdir):
+    some_code = "import a\n\ndef b(c):\n    return c\n"
+    path = str(tmpdir.join("tree.rbfst"))
+    RedBaron(some_code).save(path)
+    red = RedBaron.load(path)
+    assert red[0]._is_lazy("value")
+    assert red.find("def").name == "b"
+    assert red.dumps() == some_code
+    assert red.fst() == RedBaron(some_code).fst()
+    red.find("def").name = "d"
+    assert red.dumps() == some_code.replace("def b", "def d")
+
+
+def test_pickle_loaded(tmpdir):
+    some_code = "import a\n\ndef b(c):\n    return c\n"
+    path = str(tmpdir.join("tree.rbfst"))
+    RedBaron(some_code).save(path)
+    red = RedBaron.load(path)
+    red.find("def")
+    pickled = pickle.loads(pickle.dumps(red))
+    assert pickled.dumps() == some_code
+    assert pickled.find("return").value.value == "c"
+
+
+def test_close_loaded(tmpdir):
+    some_code = "import a\n\ndef b(c):\n    return c\n"
+    path = str(tmpdir.join("tree.rbfst"))
+    RedBaron(some_code).save(path)
+    red = RedBaron.load(path)
+    copy = red[0].copy()
+    red.find("def").name = "d"
+    red.close()
+    red.close()
+    assert red.dumps() == some_code.replace("def b", "def d")
+    assert red.find("return").value.value == "c"
+    assert copy.dumps() == "import a"
+
+
+def test_copy_is_a_structural_clone():
+    red = RedBaron("def a(x, y):\n    return x + y  # sum\n")
+    funcdef = red[0]
+    copy = funcdef.copy()
+    assert copy is not funcdef
+    assert copy.parent is None
+    assert copy.fst() == funcdef.fst()
+    assert copy.value[1].parent is copy
+    assert copy.value[1].value.parent is copy.value[1]
+    assert copy.value[1].value is not funcdef.value[1].value
+    copy.name = "b"
+    assert funcdef.name == "a"
+
+
+def test_copy_share_formatting():
+    red = RedBaron("def a(x, y):\n    return x + y  # sum\n")
+    copy = red[0].copy(share_formatting=True)
+    assert copy.dumps() == red[0].dumps()
+    assert copy.first_formatting.parent is copy
+    assert copy.first_formatting[0] is not red[0].first_formatting[0]
+    copy.first_formatting[0].value = "  "
+    assert red[0].first_formatting[0].value == " "
+
+
+def test_copy_lazy():
+    red = RedBaron("def a(x, y):\n    return x + y  # sum\n", lazy=True)
+    copy = red.copy()
+    assert copy.fst() == red.fst()
+    assert copy[0].value[1].parent is copy[0]
+
+
+def test_equal_nodes_have_the_same_hash():
+    red = RedBaron("def a(x):\n    return x + 1\ndef a(x):\n    return x + 1\n")
+    first, second = red.find_all("def")
+    assert first == second
+    assert hash(first) == hash(second)
+    assert len(set([first, second])) == 1
+    assert {first: 1}[second] == 1
+
+
+def test_hash_updated_on_modification():
+    red = RedBaron("def a(x):\n    return x + 1\ndef a(x):\n    return x + 1\n")
+    first, second = red.find_all("def")
+    hash(first)
+    first.find("name", value="x").value = "y"
+    assert first != second
+    assert hash(first) != hash(second)
+    first.find("name", value="y").value = "x"
+    assert first == second
+    assert hash(first) == hash(second)
+    second.value.append(red.find("return").copy())
+    assert first != second
+    second.value.pop()
+    assert first == second
+    assert hash(first) == hash(second)
+
+
+def test_hash_of_modified_node_matches_new_tree():
+    red = RedBaron("class A:\n    def a(self):\n        return self.x\n")
+    hash(red[0])
+    red.find("name", value="x").value = "y"
+    assert hash(red[0]) == hash(RedBaron("class A:\n    def a(self):\n        return self.y\n")[0])
+
+
+def test_identity_key():
+    red = RedBaron("a = 1\na = 1\n")
+    first, second = red.find_all("assignment")
+    mapping = {first.identity_key(): "first", IdentityKey(second): "second"}
+    assert len(mapping) == 2
+    first.value = "2"
+    assert mapping[first.identity_key()] == "first"
+    assert mapping[second.identity_key()] == "second"
+    assert first.identity_key().node is first
+    assert first.identity_key() != first
+    # the nodes themselves are still hashed by content
+    assert hash(second) == hash(RedBaron("a = 1\n")[0])
+
+
+INDEX_SOURCE = """\
+import os
+
+def a(x):
+    return os.path.join(x, "a")
+
+class B(object):
+    def c(self):
+        return a(self)
+
+    def d(self, y=a):
+        pass
+"""
+
+
+def test_index_same_results():
+    red = RedBaron(INDEX_SOURCE)
+    indexed = RedBaron(INDEX_SOURCE)
+    indexed.enable_index()
+    for identifier, kwargs in (("def", {}), ("name", {}), ("name", {"value": "a"}), ("call", {}), ("string", {}), ("endl", {}), ("Def", {"name": "d"})):
+        assert indexed.find_all(identifier, **kwargs).fst() == red.find_all(identifier, **kwargs).fst()
+        assert indexed.find(identifier, **kwargs).fst() == red.find(identifier, **kwargs).fst()
+        assert indexed("class")[0].find_all(identifier, **kwargs).fst() == red("class")[0].find_all(identifier, **kwargs).fst()
+
+
+def test_index_subtree():
+    red = RedBaron(INDEX_SOURCE)
+    red.enable_index()
+    assert red.find("def", name="c").find_all("name").map(lambda x: x.value) == ["a", "self"]
+    assert red.find("def", name="c").find("def") is red.find("def", name="c")
+    assert red.find("class").find("return", recursive=False) is None
+
+
+def test_index_follows_modifications():
+    red = RedBaron(INDEX_SOURCE)
+    red.enable_index()
+    assert len(red.find_all("def")) == 3
+
+    red.find("def", name="c").name = "e"
+    assert red.find("def", name="c") is None
+    assert red.find("def", name="e") is not None
+
+    red.append(RedBaron("def f():\n    pass\n")[0])
+    assert red.find_all("def")[-1].name == "f"
+
+    del red[red.index(red.find("def", name="a"))]
+    assert [x.name for x in red.find_all("def")] == ["e", "d", "f"]
+
+    red.find("def", name="d").value = "return 42"
+    assert red.find("def", name="d").find("int").value == 42
+
+    red.find("class").inherit_from = "x"
+    assert red.find("class").find("name", value="x") is not None
+
+
+def test_index_is_spliced():
+    red = RedBaron(INDEX_SOURCE)
+    red.enable_index()
+    assert red.find("def", name="c").find("assignment") is None
+    import_span = red._index.spans[id(red[0])]
+    class_span = red._index.spans[id(red.find("class"))]
+
+    red.find("def", name="c").append_value("z = 1")
+    assert [x.target.value for x in red.find("def", name="c").find_all("assignment")] == ["z"]
+    red.find("def", name="d").append_value("z = 2")
+    assert red.find("class").find_all("assignment").map(lambda x: x.value.value) == [1, 2]
+    red.append(RedBaron("z = 3\n")[0])
+    assert red.find_all("assignment").map(lambda x: x.value.value) == [1, 2, 3]
+    assert red.find_all("name", value="z") == red.find_all("assignment").map(lambda x: x.target)
+
+    # the nodes around the modifications keep their positions
+    assert red._index.spans[id(red[0])] == import_span
+    assert red._index.spans[id(red.find("class"))] == class_span
+
+    # without room between the positions, the index is rebuilt
+    red._index.GAP = 1
+    red._index.nodes = None
+    red.find("def", name="a").append_value("z = 4")
+    assert red.find_all("assignment").map(lambda x: x.value.value) == [4, 1, 2, 3]
+
+
+def test_index_of_a_tree_holding_a_node_of_another_tree():
+    red = RedBaron("a\n")
+    red.enable_index()
+    red.find_all("name")
+    other = RedBaron("def k():\n    x = 1\n")
+    red.append(other[0])
+    assert red.find("def").parent is other
+
+    red.find("def").value[1].value = "y"
+    assert red.find("name", value="y") is red.find("def").value[1].value
+    red.find("name", value="x").value = "w"
+    assert red.find("name", value="w") is red.find("def").value[1].target
+    assert red.find("name", value="x") is None
+    red.find("def").value.append(RedBaron("z = 2\n")[0])
+    assert red.find("name", value="z") is not None
+
+
+def test_slices_are_modifications():
+    red = RedBaron("def a():\n    b = 1\n    c = 2\n")
+    red.enable_index()
+    assert red.dumps() == "def a():\n    b = 1\n    c = 2\n"
+    assert len(red.find_all("assignment")) == 2
+    del red[0].value[1:3]
+    assert red.dumps() == "def a():\n    c = 2\n"
+    assert [x.target.value for x in red.find_all("assignment")] == ["c"]
+    red[0].value[1:1] = [RedBaron("d = 3\n")[0].copy(), red[0].value[0].copy()]
+    assert red.dumps() == "def a():\n    d = 3\n    c = 2\n"
+    assert [x.target.value for x in red.find_all("assignment")] == ["d", "c"]
+
+
+def test_find_iter():
+    red = RedBaron("a = b + c\nd = e\n")
+    found = red.find_iter("name")
+    assert not isinstance(found, list)
+    assert [x.value for x in found] == ["a", "b", "c", "d", "e"]
+    assert [x.value for x in red.find_iter("name", limit=2)] == ["a", "b"]
+    assert [x.value for x in red[0].find_iter("name", limit=10)] == ["a", "b", "c"]
+    assert [x.value for x in red[0].value.find_iter("name")] == ["b", "c"]
+    assert [x.value for x in red.find_iter("name", value="d")] == ["d"]
+    assert list(red[0].find_iter("name", recursive=False)) == []
+
+
+def test_find_iter_index():
+    red = RedBaron("a = b + c\nd = e\n")
+    red.enable_index()
+    assert [x.value for x in red.find_iter("name", limit=2)] == ["a", "b"]
+    assert [x.value for x in red[2].find_iter("name")] == ["d", "e"]
+
+
+def test_find_iter_is_lazy():
+    red = RedBaron("a = b\n" * 10, lazy=True)
+    assert next(red.find_iter("name")).value == "a"
+    assert red[-2]._is_lazy("target")
+
+
+def test_child_keys():
+    red = RedBaron("def a(x): return x\nb = 1\nc += 1\n")
+    assert red[0]._child_keys == ("decorators", "arguments", "value")
+    assert red.find("assignment", operator="+")._child_keys == ("target", "value")
+    assert red.find("assignment", operator=None)._child_keys == ("target", "operator", "value")
+    assert red[0]._get_children() == list(red[0].arguments) + list(red[0].value)
+
+
+SELECTOR_SOURCE = """\
+class Foo(object):
+    def a(self):
+        b(c(1))
+
+    def d(self):
+        if x:
+            e()
+
+class Bar(object):
+    def a(self):
+        f()
+"""
+
+
+def test_select():
+    red = RedBaron(SELECTOR_SOURCE)
+    assert [x.dumps() for x in red.select("class[name=Foo] def call")] == ["(c(1))", "(1)", "()"]
+    assert [x.name for x in red.select("class[name=Foo] > def")] == ["a", "d"]
+    assert [x.name for x in red.select("class > def[name=a]")] == ["a", "a"]
+    assert red.select("class > def > call") == []
+    assert [x.dumps() for x in red.select("def > atomtrailers")] == ["b(c(1))", "f()"]
+    assert [x.dumps() for x in red.select("class[name='Bar'] *>name")] == ["f"]
+    assert red("class")[0].select("class > def[name=d] if") == red.find_all("if")
+    assert red.select(Selector("def[name=d]")) == red.find_all("def", name="d")
+
+
+def test_select_invalid():
+    for selector in ("", ">", "def >", "def > > call", "def[name=a", "[name=a]", "def [name=a]", "def-call"):
+        with pytest.raises(ValueError):
+            Selector(selector)
+
+
+def test_index_values():
+    red = RedBaron(INDEX_SOURCE)
+    red.enable_index()
+    assert [x.parent.type for x in red.find_all("name", value="a")] == ["atomtrailers", "def_argument"]
+    assert red.find("class").find_all("name", value="x") == []
+    assert red.find_all("def", name="c")[0] is red.find("class").value[1]
+
+    red.find("name", value="x").value = "z"
+    # setting a string attribute only moves the node in the values index
+    assert red._index.pending == []
+    assert [x.value for x in red.find_all("name", value="z")] == ["z"]
+    assert red.find_all("name", value="x") == []
+    assert red.find("def", name="a").find("name", value="z").parent.type == "call_argument"
+
+    red.find("def", name="c").name = "x"
+    assert red.find("def", name="c") is None
+    assert red.find("def", name="x").find("name", value="self") is not None
+
+    red.find("def", name="x").value = "return 42"
+    assert red.find("int", value=42).parent.type == "return"
+
+
+def test_index_values_of_a_node_held_twice():
+    red = RedBaron("a = b + c\nd = e.f(g)\nh = [i, j]\nk = l\n")
+    red.enable_index()
+    red.find_all("name", value="a")
+    red[6].value = red[4].value
+    assert len(red.find_all("list")) == 2
+    assert red._index.counts[id(red[6].value)] == 2
+    red.find_all("name")[9].value = "z"
+    assert red.find_all("name", value="z") == [red[4].value.value[2]] * 2
+    assert red.find_all("name", value="j") == []
+
+
+def test_visitor():
+    red = RedBaron(SELECTOR_SOURCE)
+    calls = []
+    visitor = Visitor()
+    visitor.register("class", lambda node: calls.append("class " + node.name))
+    visitor.register("def", lambda node: calls.append("def " + node.name), name="a")
+    visitor.register("call", lambda node: calls.append(node.dumps()))
+    visitor.register_post("class", lambda node: calls.append("end " + node.name))
+    visitor.visit(red)
+    assert calls == ["class Foo", "def a", "(c(1))", "(1)", "()", "end Foo", "class Bar", "def a", "()", "end Bar"]
+
+
+def test_visitor_skip():
+    red = RedBaron(SELECTOR_SOURCE)
+    calls = []
+    visitor = Visitor()
+    visitor.register("def", lambda node: Visitor.SKIP if node.name == "a" else None)
+    visitor.register("*", lambda node: calls.append(node.type))
+    visitor.register_post("def", lambda node: calls.append("end " + node.name))
+    visitor.visit(red[0])
+    assert calls == ["class", "name", "endl", "funcdef", "end a", "funcdef", "def_argument", "endl", "ifelseblock",
+                     "if", "name", "endl", "atomtrailers", "name", "call", "endl", "endl", "end d"]
+
+
 def test_indentation_no_parent():
     red = RedBaron("a")
     assert red[0].copy().get_indentation_node() is None
@@ -1135,3 +2019,60 @@ def test_path_value_second_endl(red):
             make_path([0, "value"], "list", 2)
         )
 
+
+
+def test_path_from_subtree(red):
+    paths = Path.from_subtree(red)
+    assert [x.node for x in paths] == red.select("*")
+    for path in paths:
+        check_path(red, path.node, path.to_baron_path())
+
+    paths = Path.from_subtree(red.funcdef.value)
+    assert paths[0].node is red.funcdef.value[0]
+    assert [x.to_baron_path() for x in paths] == [x.node.path().to_baron_path() for x in paths]
+
+
+def test_path_cache_invalidated(red):
+    check_path(red,
+            red.funcdef.value[1].value.second,
+            make_path([0, "value", 1, "value"], "binary_operator", 4)
+        )
+    second = red.funcdef.value[1].value.second
+    red.funcdef.value[1].value = second
+    check_path(red, second, make_path([0, "value", 1], "assignment", 5))
+    red.funcdef.value.insert(0, red.funcdef.value[0].copy())
+    check_path(red, second, make_path([0, "value", 2], "assignment", 5))
+
+
+def test_path_cache_after_direct_data_modification():
+    red = RedBaron("a\nb\nc\n")
+    c = red[4]
+    assert c.path().to_baron_path() == make_path([], "list", 4)
+    red.data.reverse()
+    assert c.path().to_baron_path() == make_path([], "list", red.index(c))
+
+
+def test_path_node_list_attribute_set(red):
+    red.funcdef.arguments = "x, y"
+    check_path(red, red.funcdef.arguments[0], make_path([0, "arguments"], "list", 0))
+
+
+def test_find_by_paths(red):
+    nodes = red.find_all("name") + [red[0].value[0], red[0], red[0].arguments[1]]
+    paths = [x.path().to_baron_path() for x in nodes]
+    paths.append(paths[0])
+    nodes.append(nodes[0])
+    found = red.find_by_paths(paths)
+    assert len(found) == len(nodes)
+    assert all(x is y for x, y in zip(found, nodes))
+
+
+def test_find_by_paths_empty_path(red):
+    assert red.find_by_paths([make_path()]) == [red]
+    assert red.find_by_paths([]) == []
+
+
+def test_node_find_by_path(red):
+    path = red[0].value[0].path().to_baron_path()
+    assert red[0].find_by_path(make_path(path.path[1:], path.node_type, path.position_in_rendering_list)) is red[0].value[0]
+    assert red[0].find_by_paths([make_path(path.path[1:], path.node_type, path.position_in_rendering_list)]) == [red[0].value[0]]